@@ -0,0 +1,115 @@
+import dolfin as df
+import surfaise as sf
+import os
+import ufl
+from surfaise.solvers import SurfaceIPCS
+from surfaise.common.io import Timeseries
+from surfaise.common.cmd import info_blue, info_cyan
+
+
+parameters = dict(
+    R=30.,  # Major Radius. "Default" values: R=30, r=10
+    r=10.,  # Minor Radius.
+    res=200,  # Resolution
+    dt=1e-1,
+    rho=0.01,
+    mu=1.0,
+    convection="semi-implicit",
+    restart_folder=None,
+    folder="results_ns_ipcs_torus",
+    t_0=0.0,
+    tstep=0,
+    T=2000,
+    dump_intv=5,
+    checkpoint_intv=50,
+    verbose=True,
+    init_mode="random",
+)
+cmd_kwargs = sf.cmd.parse_command_line()
+parameters.update(**cmd_kwargs)
+if parameters["restart_folder"]:
+    sf.io.load_parameters(parameters, os.path.join(
+        parameters["restart_folder"], "parameters.dat"))
+    parameters.update(**cmd_kwargs)
+
+R = parameters["R"]
+r = parameters["r"]
+res = parameters["res"]
+dt = sf.TimeStepSelector(parameters["dt"])
+rho = df.Constant(parameters["rho"])
+mu = df.Constant(parameters["mu"])
+
+geo_map = sf.TorusMap(R, r)
+geo_map.initialize(res, restart_folder=parameters["restart_folder"])
+
+f = df.Expression(("0.1*exp(-pow(x[1]-1.57,2)/2*0.01)", "0."), degree=2)
+
+ns = SurfaceIPCS(geo_map, rho=rho, mu=mu, dt=dt, f=f,
+                 convection=parameters["convection"])
+
+# Mixed function for output and checkpointing
+W = geo_map.mixed_space((geo_map.ref_vel, geo_map.ref_el))
+w_ = df.Function(W, name="u_")
+w_1 = df.Function(W, name="u_1")
+
+# Create intial conditions
+if parameters["restart_folder"] is None:
+    init_mode = parameters["init_mode"]
+    if init_mode == "random":
+        w_init = sf.ics.RandomIC(w_, degree=1)
+    else:
+        exit("Unknown IC")
+    w_.interpolate(w_init)
+else:
+    sf.io.load_checkpoint(parameters["restart_folder"], w_, w_1)
+ns.assign_from(w_)
+
+u_ = ns.u_
+
+df.parameters["form_compiler"]["optimize"] = True
+df.parameters["form_compiler"]["cpp_optimize"] = True
+
+#
+t = parameters["t_0"]
+tstep = parameters["tstep"]
+T = parameters["T"]
+
+# Output file
+ts = Timeseries(parameters["folder"], w_,
+                ("u", "p"), geo_map, tstep,
+                parameters=parameters,
+                restart_folder=parameters["restart_folder"])
+
+# Define some UFL indices:
+i, j = ufl.Index(), ufl.Index()
+
+E_kin = 0.5*rho*geo_map.g_ab[i, j]*u_[i]*u_[j]
+divu = geo_map.CovD10(u_)[i, i]
+U = [sum([geo_map.get_function(xi + "_," + vj)*u_[dj]
+          for dj, vj in enumerate(geo_map.AXIS_REF)])
+     for xi in geo_map.AXIS]
+
+ts.add_field(E_kin, "E_kin")
+ts.add_field(divu, "divu")
+ts.add_field(U, "U")
+
+# Step in time
+ts.dump(tstep)
+
+while t < T:
+    tstep += 1
+    info_cyan("tstep = {}, time = {}".format(tstep, t))
+
+    w_1.assign(w_)
+    ns.step()
+    ns.assign_to(w_)
+
+    t += dt.get()
+
+    if tstep % parameters["dump_intv"] == 0:
+        ts.dump(t)
+        info_blue("dt = {}".format(dt.get()))
+
+    if tstep % parameters["checkpoint_intv"] == 0 or t >= T:
+        ts.checkpoint(tstep, t, geo_map.ref_mesh,
+                      w_, None, parameters)
@@ -3,7 +3,7 @@ import surfaise as sf
 import os
 import ufl
 from surfaise.common.io import (
-    Timeseries, save_checkpoint, load_checkpoint,
+    Timeseries, load_checkpoint,
     load_parameters)
 from surfaise.common.cmd import (
     mpi_max, parse_command_line, info_blue, info_cyan)
@@ -168,5 +168,5 @@ while t < T:
         # ts.dump_stats(t, "data")
 
     if tstep % parameters["checkpoint_intv"] == 0 or t >= T:
-        save_checkpoint(tstep, t, geo_map.ref_mesh,
-                        w_, w_1, ts.folder, parameters)
+        ts.checkpoint(tstep, t, geo_map.ref_mesh,
+                      w_, None, parameters)
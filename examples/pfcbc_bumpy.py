@@ -1,13 +1,14 @@
 import dolfin as df
 from surfaise import BumpyMap
 from surfaise.common.io import (
-    Timeseries, save_checkpoint, load_checkpoint,
+    Timeseries, load_checkpoint,
     load_parameters)
 from surfaise.common.cmd import (
     mpi_max, parse_command_line, info_blue,
     info_cyan, info_red, mpi_any)
 from surfaise.common.utilities import (
     QuarticPotential, TimeStepSelector, anneal_func)
+from surfaise.common.diagnostics import Functionals
 from surfaise.ics import StripedIC, RandomIC
 import os
 import ufl
@@ -181,6 +182,7 @@ E_0 = (2*nu_**2 - 2 * geo_map.gab[i, j]*psi_.dx(i)*psi_.dx(j) + w(psi_, tau))
 E_2 = (h**2/12)*(2*(4*nuhat_**2 + 4*H*nuhat_*nu_ - 5*K*nu_**2)
                  - 2 * (2*H*nuhat_ - 2*K*gab[i, j]*psi_.dx(i)*psi_.dx(j))
                  + (tau/2)*K*psi_**2 + (1/4)*K*psi_**4)
+energy = Functionals(geo_map, dict(E_0=E_0, E_2=E_2))
 ts.add_field(E_0, "E_0")
 ts.add_field(E_2, "E_2")
 ts.add_field(df.sqrt(geo_map.gab[i, j]*mu_.dx(i)*mu_.dx(j)),
@@ -212,8 +214,8 @@ while t < T:
                     parameters["t_ramp"]))
 
         u_.assign(u_1)
-        Eout_0 = df.assemble(geo_map.form(E_0))
-        Eout_2 = df.assemble(geo_map.form(E_2))
+        E_out = energy()
+        Eout_0, Eout_2 = E_out["E_0"], E_out["E_2"]
         E_before = Eout_0 + Eout_2
 
 
@@ -234,8 +236,8 @@ while t < T:
             dt.chop()
             info_blue("New timestep is: dt = {}".format(dt.get()))
 
-        Eout_0 = df.assemble(geo_map.form(E_0))
-        Eout_2 = df.assemble(geo_map.form(E_2))
+        E_out = energy()
+        Eout_0, Eout_2 = E_out["E_0"], E_out["E_2"]
         E_after = Eout_0 + Eout_2
         dE = E_after - E_before
         if not initial_step and dE > 0.0:
@@ -263,9 +265,11 @@ while t < T:
                        Eout_0, Eout_2,
                        Eout_0 + Eout_2, float(tau.values()),
                        dE, dumax],
-                      "data")
+                      "data",
+                      columns=["grad_mu_max", "dt_prev", "dt", "h",
+                               "E_0", "E_2", "E", "tau", "dE", "dumax"])
 
     if tstep % parameters["checkpoint_intv"] == 0 or t >= T:
-        save_checkpoint(tstep, t, geo_map.ref_mesh,
-                        u_, u_1, ts.folder, parameters)
+        ts.checkpoint(tstep, t, geo_map.ref_mesh,
+                      u_, None, parameters)
     t_prev = t
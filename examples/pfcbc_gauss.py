@@ -1,13 +1,16 @@
 import dolfin as df
 from surfaise import GaussianBumpMapRound
 from surfaise.common.io import (
-    Timeseries, save_checkpoint, load_checkpoint,
+    Timeseries, load_checkpoint,
     load_parameters)
 from surfaise.common.cmd import (
-    mpi_max, parse_command_line, info_blue,
+    parse_command_line, info_blue,
     info_cyan, info_red, mpi_any)
-from surfaise.common.utilities import (
-    QuarticPotential, TimeStepSelector, anneal_func)
+from surfaise.common.utilities import QuarticPotential, anneal_func
+from surfaise.common.timestepping import (
+    AdaptiveTimeStepSelector, ExtrapolationErrorEstimator)
+from surfaise.common.diagnostics import Functionals
+from surfaise.common.reductions import ExtremaReducer, HistogramReducer
 from surfaise.ics import StripedIC, RandomIC
 import os
 import ufl
@@ -20,6 +23,8 @@ parameters = dict(
     num_modes=5,
     res=220,  # Resolution
     dt=1e-1,
+    dt_tol=1e-3,  # Tolerance of the local error estimate
+    reject_energy_increase=False,
     tau=0.2,
     t_ramp=500.,
     tau_ramp=0.98,
@@ -31,6 +36,8 @@ parameters = dict(
     tstep=0,
     T=5000,
     checkpoint_intv=50,
+    dump_intv=5,
+    reduce_intv=1,
     verbose=True,
     anneal=True,
     init_mode="random",
@@ -47,7 +54,8 @@ R = parameters["R"]
 H = parameters["H"]
 num_modes = parameters["num_modes"]
 res = parameters["res"]
-dt = TimeStepSelector(parameters["dt"])
+dt = AdaptiveTimeStepSelector(parameters["dt"], tol=parameters["dt_tol"],
+                              dt_max=parameters["t_ramp"]/100)
 tau = df.Constant(parameters["tau"])
 h = df.Constant(parameters["h"])
 M = df.Constant(parameters["M"])
@@ -169,15 +177,37 @@ E_0 = (2*nu_**2 - 2 * geo_map.gab[i, j]*psi_.dx(i)*psi_.dx(j) + w(psi_, tau))
 E_2 = (h**2/12)*(2*(4*nuhat_**2 + 4*H*nuhat_*nu_ - 5*K*nu_**2)
                  - 2 * (2*H*nuhat_ - 2*K*gab[i, j]*psi_.dx(i)*psi_.dx(j))
                  + (tau/2)*K*psi_**2 + (1/4)*K*psi_**4)
+energy = Functionals(geo_map, dict(E_0=E_0, E_2=E_2))
+error = ExtrapolationErrorEstimator(u_, u_1, dt)
 ts.add_field(E_0, "E_0")
 ts.add_field(E_2, "E_2")
 ts.add_field(df.sqrt(geo_map.gab[i, j]*mu_.dx(i)*mu_.dx(j)),
                     "abs_grad_mu")
 
+# In-situ reductions of psi, logged to Statistics
+ts.add_reducer(ExtremaReducer(geo_map, psi_, name="psi_extrema"),
+               parameters["reduce_intv"])
+ts.add_reducer(HistogramReducer(geo_map, psi_, np.linspace(-1.5, 1.5, 31),
+                                name="psi_histogram"),
+               parameters["reduce_intv"])
+
 # Step in time
 ts.dump(tstep)
 
 initial_step = bool(parameters["restart_folder"] is None)
+E = dict()
+
+
+def energy_decreases():
+    """ Acceptance criterion: the energy must not increase. """
+    E.update(energy())
+    dE = E["E_0"] + E["E_2"] - E_before
+    return (initial_step or not parameters["reject_energy_increase"]
+            or dE <= 1e-1)
+
+
+dt.add_acceptance_criterion(energy_decreases)
+
 t_prev = t
 while t < T:
     tstep += 1
@@ -194,59 +224,52 @@ while t < T:
                 parameters["t_ramp"]))
 
     # Compute energy
-    # u_.assign(u_1)
-    Eout_0 = df.assemble(geo_map.form(E_0))
-    Eout_2 = df.assemble(geo_map.form(E_2))
-    E_before = Eout_0 + Eout_2
+    E_out = energy()
+    E_before = E_out["E_0"] + E_out["E_2"]
 
-    converged = False
-    while not converged:
+    accepted = False
+    while not accepted:
         try:
             solver.solve()
-            converged = True
-        except:
+        except RuntimeError:
             info_blue("Did not converge. Chopping timestep.")
+            u_.assign(u_1)
             dt.chop()
             info_blue("New timestep is: dt = {}".format(dt.get()))
-
-        if converged:
-            Eout_0 = df.assemble(geo_map.form(E_0))
-            Eout_2 = df.assemble(geo_map.form(E_2))
-            E_after = Eout_0 + Eout_2
-            dE = E_after - E_before
-            if not initial_step and dE > 1e-1 and False:
-                info_blue("Converged, but energy increased. Chopping timestep.")
-                info_blue("E_before = {}".format(E_before))
-                info_blue("E_after  = {}".format(E_after))
-                info_blue("dE       = {}".format(dE))
-                info_blue("dt       = {}".format(dt.get()))
-                dt.chop()
-                converged = False
+            continue
+        err = error()
+        accepted = dt.adapt(err)
+        if not accepted:
+            u_.assign(u_1)
 
     initial_step = False
-
-    # Update time with final dt value
-    t += dt.get()
-    # Set dt:
-    grad_mu_ufl = df.sqrt(geo_map.gab[i, j]*mu_.dx(i)*mu_.dx(j))
-    grad_mu = df.project(grad_mu_ufl, geo_map.S_ref)
-    grad_mu_max = mpi_max(grad_mu.vector().get_local())
-    dt_prev = dt.get()
-    dt.set(min(min(0.25/grad_mu_max, T-t), parameters["t_ramp"]/100))
+    error.update()
+
+    # Update time with the accepted dt value
+    dt_prev = dt.dt_prev
+    t += dt_prev
+    Eout_0, Eout_2 = E["E_0"], E["E_2"]
+    dE = Eout_0 + Eout_2 - E_before
+    if T - t > 0:
+        dt.set(min(dt.get(), T-t))
     info_blue("dt = {}".format(dt.get()))
 
-    if tstep % 5 == 0 or np.floor(t/1000)-np.floor(t_prev/1000) > 0:
+    if (tstep % parameters["dump_intv"] == 0
+            or np.floor(t/1000)-np.floor(t_prev/1000) > 0):
         ts.dump(t)
 
+    ts.reduce(t, tstep)
     ts.dump_stats(t,
-                  [grad_mu_max, dt_prev, dt.get(),
+                  [np.nan if err is None else err, dt_prev, dt.get(),
                    float(h.values()),
                    Eout_0, Eout_2,
                    Eout_0 + Eout_2, float(tau.values()),
                    dE],
-                  "data")
+                  "data",
+                  columns=["err", "dt_prev", "dt", "h",
+                           "E_0", "E_2", "E", "tau", "dE"])
 
     if tstep % parameters["checkpoint_intv"] == 0 or t >= T:
-        save_checkpoint(tstep, t, geo_map.ref_mesh,
-                        u_, u_1, ts.folder, parameters)
+        ts.checkpoint(tstep, t, geo_map.ref_mesh,
+                      u_, None, parameters)
     t_prev = t
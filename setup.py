@@ -23,6 +23,7 @@ setup(
     packages=["surfaise",
               "surfaise.common",
               "surfaise.utilities",
+              "surfaise.solvers",
               "surfaise.analysis_scripts"],
     package_dir={"surfaise": "surfaise"},
     entry_points={"console_scripts": [
@@ -14,7 +14,12 @@ from .maps import (
 import surfaise.common.io as io
 import surfaise.common.cmd as cmd
 from .common.utilities import QuarticPotential, TimeStepSelector
+from .common.timestepping import (
+    AdaptiveTimeStepSelector,
+    ExtrapolationErrorEstimator,
+    StepDoublingErrorEstimator)
 import surfaise.ics as ics
+import surfaise.solvers as solvers
 
 __author__ = "Gaute Linga and Bjarke Frost Nielsen"
 __author_email__ = "gaute.linga@mn.uio.no"
@@ -48,6 +53,10 @@ __all__ = [
     "io",
     "cmd",
     "ics",
+    "solvers",
     "QuarticPotential",
     "TimeStepSelector",
+    "AdaptiveTimeStepSelector",
+    "ExtrapolationErrorEstimator",
+    "StepDoublingErrorEstimator",
 ]
@@ -5,95 +5,100 @@ from utilities.plot import plot_any_field
 import os
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib.tri as mtri
 from skimage.morphology import skeletonize
-from scipy.ndimage import measurements
+from scipy import ndimage
+from scipy.sparse import csr_matrix
 
 
 def description(ts, **kwargs):
     info("Get topological skeleton.")
 
 
-def extract_defects(nodes, z):
-    z = np.asarray(z > 0, dtype=float)
-    data = dict()
-    for xi, yi, zi in zip(nodes[:, 0], nodes[:, 1], z):
-        key = tuple((xi, yi))
-        data[key] = zi
-
-    x = np.unique(nodes[:, 0])
-    y = np.unique(nodes[:, 1])
-    nx = len(x)
-    ny = len(y)
-
-    Z = np.zeros((ny, 3*nx))
-    for i, x_loc in enumerate(x):
-        for j, y_loc in enumerate(y):
-            val = data[(x_loc, y_loc)]
-            Z[j, i] = val
-            Z[j, nx+i] = val
-            Z[j, 2*nx+i] = val
-
-    s = skeletonize(Z)
-    s = s[:, nx:2*nx]
-    Z = Z[:, nx:2*nx]
-
-    adjacents = {(-1, 1), (0, 1), (1, 1),
-                 (-1, 0), (1, 0),
-                 (-1, -1), (0, -1), (1, -1)}
-
-    B = np.zeros(s.shape)
-    for i, row in enumerate(s):
-        for j, val in enumerate(row):
-            if s[i, j]:
-                for di, dj in adjacents:
-                    imod = (i+di) % ny
-                    jmod = (j+dj) % nx
-                    B[i, j] += s[imod, jmod]
-
-    I, J = np.meshgrid(range(nx), range(ny))
-
-    B2 = np.asarray(np.logical_and(B > 2, B < 4))
-    lw, num = measurements.label(B2)
-    T = np.zeros_like(lw)
-    for c in range(1, lw.max()+1):
-        ids = (lw == c)
-        ic = int(np.round(np.mean(I[ids])))
-        jc = int(np.round(np.mean(J[ids])))
-        T[jc, ic] = 1
+def raster_matrix(nodes, elems, shape=None):
+    """ Sparse matrix interpolating nodal (P1) values onto a uniform,
+    periodic (ny, nx) grid on the bounding box of the nodes, and the grid
+    shape. By default, the grid has about as many pixels as nodes. """
+    x_min = nodes[:, :2].min(axis=0)
+    L = nodes[:, :2].max(axis=0) - x_min
+    if shape is None:
+        nx = int(np.round(np.sqrt(len(nodes)*L[0]/L[1])))
+        shape = (int(np.round(len(nodes)/nx)), nx)
+    ny, nx = shape
+    X, Y = np.meshgrid(x_min[0] + L[0]*np.arange(nx)/nx,
+                       x_min[1] + L[1]*np.arange(ny)/ny)
+    X, Y = X.ravel(), Y.ravel()
+
+    triangulation = mtri.Triangulation(nodes[:, 0], nodes[:, 1], elems)
+    cells = triangulation.get_trifinder()(X, Y)
+    pixels = np.flatnonzero(cells >= 0)
+    vertices = elems[cells[pixels]]
+
+    # Barycentric coordinates
+    x = nodes[vertices, 0]
+    y = nodes[vertices, 1]
+    det = ((y[:, 1] - y[:, 2])*(x[:, 0] - x[:, 2])
+           + (x[:, 2] - x[:, 1])*(y[:, 0] - y[:, 2]))
+    lam_0 = ((y[:, 1] - y[:, 2])*(X[pixels] - x[:, 2])
+             + (x[:, 2] - x[:, 1])*(Y[pixels] - y[:, 2]))/det
+    lam_1 = ((y[:, 2] - y[:, 0])*(X[pixels] - x[:, 2])
+             + (x[:, 0] - x[:, 2])*(Y[pixels] - y[:, 2]))/det
+    lam = np.vstack((lam_0, lam_1, 1. - lam_0 - lam_1)).T
+
+    A = csr_matrix((lam.ravel(), (np.repeat(pixels, 3), vertices.ravel())),
+                   shape=(nx*ny, len(nodes)))
+    return A, shape
+
+
+def extract_defects(z, A, shape):
+    """ Skeleton end points (Q), junctions (T) and the thresholded field
+    (Z) on the grid given by the raster matrix A and shape. """
+    ny, nx = shape
+    Z = np.asarray(A.dot(z) > 0, dtype=float).reshape(shape)
+
+    s = skeletonize(np.tile(Z, (3, 3)))
+    s = np.asarray(s[ny:2*ny, nx:2*nx], dtype=int)
+
+    kernel = np.ones((3, 3), dtype=int)
+    kernel[1, 1] = 0
+    B = s*ndimage.convolve(s, kernel, mode="wrap")
+
+    B2 = B == 3
+    lw, num = ndimage.label(B2)
+    T = np.zeros(shape, dtype=int)
+    if num > 0:
+        centers = np.round(ndimage.center_of_mass(
+            B2, lw, range(1, num+1))).astype(int)
+        T[centers[:, 0], centers[:, 1]] = 1
 
     Q = B == 1
 
     return (Q, T, Z)
 
 
-def method(ts, dt=0, save=True, **kwargs):
+def method(ts, dt=0, save=True, processes=None, **kwargs):
     """ Get topological skeleton. """
     info_cyan("Plotting at given time/step using Matplotlib.")
 
     params = ts.get_parameters()
     steps = get_steps(ts, dt)
+    A, shape = raster_matrix(ts.nodes, ts.elems)
 
-    data = np.zeros((len(steps), 4))
-
-    if save:
-        plt.figure()
-    for i, step in enumerate(steps):
+    def defects(ts, step):
         info("Step {} of {}".format(step, len(ts)))
-
-        if mpi_is_root():
-            for field in ts.fields:
-                Q, T, Z = extract_defects(ts.nodes, ts[field, step])
-
-                data[i, 0] = step
-                data[i, 1] = ts.times[step]
-                data[i, 2] = np.sum(Q)
-                data[i, 3] = np.sum(T)
-
-                # plt.figure()
-                if save:
-                    plt.imshow(T - Q + 0.5*Z)
-                    plt.savefig(os.path.join(ts.plots_folder, "defects_{}.png".format(step)))
-                # plt.show()
+        for field in ts.fields:
+            Q, T, Z = extract_defects(ts[field, step], A, shape)
+            row = [step, ts.times[step], np.sum(Q), np.sum(T)]
+
+            if save:
+                plt.figure()
+                plt.imshow(T - Q + 0.5*Z)
+                plt.savefig(os.path.join(ts.plots_folder,
+                                         "defects_{}.png".format(step)))
+                plt.close()
+        return row
+
+    data = np.array(ts.map_steps(defects, steps, processes=processes))
 
     if mpi_is_root():
         with open(os.path.join(ts.analysis_folder,
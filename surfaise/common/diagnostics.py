@@ -0,0 +1,37 @@
+import dolfin as df
+import numpy as np
+from mpi4py import MPI as pyMPI
+from .cmd import mpi_comm
+
+
+class Functionals:
+    """ Evaluates several surface integrals in one assembly.
+
+    integrands is a dict of scalar UFL integrands (without the surface
+    measure). They are combined into a single linear form over a "Real"
+    vector space, one component per integrand, so that all integrals are
+    computed in one pass over the mesh followed by one MPI reduction.
+    """
+    def __init__(self, geo_map, integrands):
+        self.names = list(integrands.keys())
+        R = df.VectorFunctionSpace(geo_map.ref_mesh, "R", 0,
+                                   dim=len(self.names))
+        r = df.TestFunction(R)
+        self.form = geo_map.form(
+            sum([integrands[name]*r[k]
+                 for k, name in enumerate(self.names)]))
+        dofmap = R.dofmap()
+        self.dofs = [
+            dofmap.local_to_global_index(R.sub(k).dofmap().cell_dofs(0)[0])
+            for k in range(len(self.names))]
+        self.b = df.PETScVector()
+
+    def __call__(self):
+        """ Returns a dict with the value of each integral. """
+        df.assemble(self.form, tensor=self.b)
+        first, last = self.b.local_range()
+        values = np.zeros(self.b.size())
+        values[first:last] = self.b.get_local()
+        mpi_comm().Allreduce(pyMPI.IN_PLACE, values, op=pyMPI.SUM)
+        return dict([(name, values[dof])
+                     for name, dof in zip(self.names, self.dofs)])
@@ -1,12 +1,20 @@
 import dolfin as df
 import os
+import hashlib
+import atexit
+from itertools import product
 from surfaise.common.cmd import mpi_is_root, mpi_barrier, mpi_comm, \
     mpi_size, mpi_rank, info_red, info_cyan, info_on_red
 import numpy as np
 import json
 import h5py
 import cloudpickle as pickle
-from .utilities import NdFunction
+from .utilities import NdFunction, Projector
+from .writers import (
+    VertexGatherer, AsyncWriter, XDMFSeries, SharedMeshSeries, GatheredFile)
+from surfaise.utilities.xdmf_utils import (
+    header_single, footer_single, grid_1st_begin, mesh_1st, grid_end,
+    attrib_template)
 
 
 def dump_xdmf(f, folder=""):
@@ -90,6 +98,118 @@ def dump_evalf(geo_map, folder=""):
             pickle.dump(geo_map.evalf, f)
 
 
+def geometry_hash(geo_map, coordinates, cells):
+    """ Hash identifying the map and the reference mesh. """
+    h = hashlib.sha1()
+    h.update(type(geo_map).__name__.encode())
+    for xi in geo_map.AXIS:
+        h.update(str(geo_map.map[xi]).encode())
+    h.update(np.ascontiguousarray(coordinates, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(cells, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def geometry_fields(geo_map, coordinates):
+    """ Evaluates the geometric quantities at the given reference
+    coordinates. Returns a dict of (attribute name, array) with vectors
+    and tensors padded to 3 and 3x3 components, keyed by file name. """
+    r_ref_vals = dict([(j, coordinates[:, dj])
+                       for dj, j in enumerate(geo_map.AXIS_REF)])
+
+    def vector(keys):
+        return np.vstack([geo_map.eval(key, r_ref_vals)
+                          for key in keys]).T
+
+    def tensor(prefix):
+        T = np.zeros((len(coordinates), 3, 3))
+        for (dj, j), (dk, k) in product(enumerate(geo_map.AXIS_REF),
+                                        enumerate(geo_map.AXIS_REF)):
+            T[:, dj, dk] = geo_map.eval(prefix + j + k, r_ref_vals)
+        return T.reshape((-1, 9))
+
+    fields = dict()
+    fields["xyz"] = ("xyz", vector(geo_map.AXIS))
+    for dj, j in enumerate(geo_map.AXIS_REF):
+        fields["dxyz{}".format(dj)] = (
+            "xyz_,{}".format(dj),
+            vector([xi + "_," + j for xi in geo_map.AXIS]))
+    fields["n"] = ("n", vector(["n_" + xi for xi in geo_map.AXIS]))
+    fields["g_ab"] = ("g_ab", tensor("g_"))
+    fields["gab"] = ("g^ab", tensor("g^"))
+    fields["K_ab"] = ("K_ab", tensor("K_"))
+    return fields
+
+
+def dump_geometry(geo_map, folder="", checkpointfolder=""):
+    """ Write the reference mesh and all geometric quantities, evaluated
+    directly at the vertices, to folder/geometry.h5, with one small xdmf
+    file per quantity pointing into it. The file is tagged with a hash of
+    the map and mesh, and nothing is written (including map.pkl and
+    evalf.pkl in checkpointfolder) if it is up to date. """
+    gatherer = VertexGatherer(geo_map.ref_mesh)
+    coordinates, cells = gatherer.gather_mesh()
+    written = False
+    if mpi_is_root():
+        geo_hash = geometry_hash(geo_map, coordinates, cells)
+        h5filename = os.path.join(folder, "geometry.h5")
+        fields = ["xyz", "n", "g_ab", "gab", "K_ab"] + [
+            "dxyz{}".format(dj) for dj in range(len(geo_map.AXIS_REF))]
+        files = [h5filename,
+                 os.path.join(checkpointfolder, "map.pkl"),
+                 os.path.join(checkpointfolder, "evalf.pkl")] + [
+                     os.path.join(folder, field + ".xdmf")
+                     for field in fields]
+        up_to_date = all([os.path.exists(f) for f in files])
+        if up_to_date:
+            with h5py.File(h5filename, "r") as h5f:
+                up_to_date = h5f.attrs.get("hash", "") == geo_hash
+        if up_to_date:
+            info_cyan("Geometry is up to date.")
+        else:
+            info_cyan("Writing geometry.")
+            _write_geometry(geo_map, h5filename, coordinates, cells,
+                            geo_hash)
+            dump_map(geo_map, folder=checkpointfolder)
+            dump_evalf(geo_map, folder=checkpointfolder)
+            written = True
+    return mpi_comm().bcast(written, root=0)
+
+
+def _write_geometry(geo_map, h5filename, coordinates, cells, geo_hash):
+    fields = geometry_fields(geo_map, coordinates)
+    tmpfilename = h5filename + ".tmp"
+    with h5py.File(tmpfilename, "w") as h5f:
+        h5f.create_dataset("Mesh/geometry", data=coordinates)
+        h5f.create_dataset("Mesh/topology",
+                           data=np.asarray(cells, dtype=np.int64))
+        for key, (name, values) in fields.items():
+            h5f.create_dataset(key, data=values)
+        h5f.attrs["hash"] = geo_hash
+    os.replace(tmpfilename, h5filename)
+
+    h5name = os.path.basename(h5filename)
+    keys = dict(
+        num_vert=coordinates.shape[0],
+        num_elem=cells.shape[0],
+        xyz_filename=h5name,
+        xyz_loc="/Mesh/geometry",
+        topology_filename=h5name,
+        topology_loc="/Mesh/topology",
+        topology_type=geo_map.ref_mesh.ufl_cell().cellname().capitalize(),
+        nodes_per_element=cells.shape[1],
+        geometry_type="XYZ" if coordinates.shape[1] == 3 else "XY",
+        geometry_dim=coordinates.shape[1])
+    field_types = {3: "Vector", 9: "Tensor"}
+    for key, (name, values) in fields.items():
+        text = header_single + grid_1st_begin + mesh_1st.format(**keys)
+        text += attrib_template(field_types[values.shape[1]]).format(
+            field=name, field_filename=h5name, field_loc="/" + key, **keys)
+        text += grid_end + footer_single
+        with open(os.path.join(os.path.dirname(h5filename),
+                               key + ".xdmf"), "w") as xdmffile:
+            xdmffile.write(text)
+
+
 def makedirs_safe(folder):
     """ Make directory in a safe way. """
     if mpi_is_root() and not os.path.exists(folder):
@@ -135,9 +255,81 @@ def create_directories(results_folder):
     return folder
 
 
+class StatisticsLogger:
+    """ Buffered logger of rows (t, data...) to a .npy file with a
+    structured dtype, one named float column per entry. Rows are kept in
+    memory and appended in blocks of buffer_size; the header is padded to
+    a fixed size so that only the shape needs to be rewritten. The file
+    can be loaded with np.load(filename, mmap_mode="r").
+
+    With text_export, the rows are also appended to a tab-separated .dat
+    file as before. Only the root process writes.
+    """
+    def __init__(self, filename, columns, buffer_size=100,
+                 text_export=False):
+        self.filename = filename + ".npy"
+        self.textfilename = filename + ".dat" if text_export else None
+        self.dtype = np.dtype([(str(c), np.float64)
+                               for c in ["t"] + list(columns)])
+        self.buffer_size = buffer_size
+        self.rows = []
+        self.num_rows = 0
+        # Room for the largest possible shape, aligned to 64 bytes
+        self.header_size = 64*((len(self._header_dict(2**63)) + 11)//64 + 1)
+        if mpi_is_root() and os.path.exists(self.filename):
+            with open(self.filename, "rb") as f:
+                np.lib.format.read_magic(f)
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                header_size = f.tell()
+            if dtype != self.dtype or header_size != self.header_size:
+                raise ValueError("{} exists with other columns.".format(
+                    self.filename))
+            self.num_rows = shape[0]
+        atexit.register(self.flush)
+
+    def _header_dict(self, num_rows):
+        return repr({"descr": np.lib.format.dtype_to_descr(self.dtype),
+                     "fortran_order": False,
+                     "shape": (num_rows,)}).encode("latin1")
+
+    def _header(self, num_rows):
+        header_len = self.header_size - 10
+        header = self._header_dict(num_rows).ljust(header_len - 1) + b"\n"
+        return (np.lib.format.magic(1, 0)
+                + np.array(header_len, dtype="<u2").tobytes() + header)
+
+    def log(self, t, data):
+        """ Add the row (t, data...). """
+        self.rows.append(tuple([t] + list(np.asarray(data).flatten())))
+        if len(self.rows) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0 or not mpi_is_root():
+            self.rows = []
+            return
+        block = np.array(self.rows, dtype=self.dtype)
+        mode = "r+b" if os.path.exists(self.filename) else "wb"
+        with open(self.filename, mode) as f:
+            f.write(self._header(self.num_rows + len(block)))
+            f.seek(self.header_size + self.num_rows*self.dtype.itemsize)
+            f.write(block.tobytes())
+        self.num_rows += len(block)
+        if self.textfilename is not None:
+            with open(self.textfilename, "a+") as outfile:
+                outfile.write("".join([
+                    "\t ".join([str(v) for v in row]) + "\n"
+                    for row in self.rows]))
+        self.rows = []
+
+
 class Timeseries:
     def __init__(self, results_folder, u_, field_names, geo_map, tstep0=0,
-                 parameters=None, restart_folder=None):
+                 parameters=None, restart_folder=None,
+                 projection="project", async_output=False, queue_size=4,
+                 shared_file=False, compression=None,
+                 single_precision=False, stats_buffer_size=100,
+                 stats_text_export=False):
         self.u_ = u_  # Pointer
         self.tstep0 = tstep0
         num_sub_el = u_.function_space().ufl_element().num_sub_elements()
@@ -155,14 +347,36 @@ class Timeseries:
             self.folder = restart_folder.split("Checkpoint")[0]
         geofolder = os.path.join(self.folder, "Geometry")
         checkpointfolder = os.path.join(self.folder, "Checkpoint")
-        dump_coords(geo_map, folder=geofolder)
-        dump_dcoords(geo_map, folder=geofolder)
-        dump_xdmf(geo_map.normal(), folder=geofolder)
-        dump_metric_tensor(geo_map, folder=geofolder)
-        dump_metric_tensor_inv(geo_map, folder=geofolder)
-        dump_curvature_tensor(geo_map, folder=geofolder)
-        dump_map(geo_map, folder=checkpointfolder)
-        dump_evalf(geo_map, folder=checkpointfolder)
+        dump_geometry(geo_map, folder=geofolder,
+                      checkpointfolder=checkpointfolder)
+
+        # With async_output, the fields are gathered to root and written
+        # by a background thread, so that output overlaps computation.
+        # HDF5 is not thread safe: save checkpoints with checkpoint(),
+        # which flushes first. Pending output is written at exit if close()
+        # is not called.
+        # With shared_file, all fields are stored with a single copy of the
+        # mesh in Timeseries/timeseries_from_tstep_*.h5.
+        self.writer = None
+        self.shared = None
+        self.gatherer = None
+        if async_output or shared_file:
+            mpi_barrier()
+            self.mesh_xdmf = os.path.join(geofolder, "xyz.xdmf")
+            self.gatherer = VertexGatherer(geo_map.ref_mesh)
+            if async_output and mpi_is_root():
+                self.writer = AsyncWriter(maxsize=queue_size)
+        if shared_file:
+            coordinates, cells = self.gatherer.gather_mesh()
+            if mpi_is_root():
+                self.shared = SharedMeshSeries(
+                    os.path.join(self.folder, "Timeseries",
+                                 "timeseries_from_tstep_{}".format(
+                                     self.tstep0)),
+                    coordinates, cells,
+                    geo_map.ref_mesh.ufl_cell().cellname().capitalize(),
+                    compression=compression,
+                    single_precision=single_precision)
 
         self.files = dict()
         for field in self.fields:
@@ -170,6 +384,8 @@ class Timeseries:
                                     "{}_from_tstep_{}".format(field,
                                                               self.tstep0))
             self.files[field] = self._create_file(filename)
+        if self.gatherer is not None and mpi_is_root():
+            atexit.register(self._close_output)
 
         if parameters:
             parametersfile = os.path.join(
@@ -179,8 +395,16 @@ class Timeseries:
 
         self.S_ref = geo_map.S_ref
 
+        self.stats = dict()
+        self.reducers = []
+        self.stats_buffer_size = stats_buffer_size
+        self.stats_text_export = stats_text_export
+
         self.extra_fields = dict()
         self.extra_field_functions = dict()
+        self.extra_field_methods = dict()
+        self.projection = projection
+        self.projectors = dict()
 
     def dump(self, tstep):
         q_ = self._unpack()
@@ -189,22 +413,30 @@ class Timeseries:
             self.files[field].write(qi_, tstep)
 
         # Dumping extra fields
-        if len(self.extra_fields) > 0:
-            # S = q_[0].function_space().collapse()
-            S = self.S_ref
-            for field, ufl_expression in self.extra_fields.items():
-                if isinstance(ufl_expression, list):
-                    v = [df.project(expr_i, S) for expr_i in ufl_expression]
-                    vf = NdFunction(v, name=field)
-                    vf()
-                    self.extra_field_functions[field] = vf
-                    self.files[field].write(vf, tstep)
-                else:
-                    self.extra_field_functions[field] = df.project(ufl_expression,
-                                                                   S)
-                    self.extra_field_functions[field].rename(field, "tmp")
-                    self.files[field].write(self.extra_field_functions[field],
-                                            tstep)
+        for field, ufl_expression in self.extra_fields.items():
+            projector = self._get_projector(self.extra_field_methods[field])
+            if isinstance(ufl_expression, list):
+                if field not in self.extra_field_functions:
+                    v = [df.Function(self.S_ref) for _ in ufl_expression]
+                    self.extra_field_functions[field] = NdFunction(v,
+                                                                   name=field)
+                vf = self.extra_field_functions[field]
+                for expr_i, v_i in zip(ufl_expression, vf.u):
+                    projector(expr_i, v_i)
+                vf()
+            else:
+                if field not in self.extra_field_functions:
+                    self.extra_field_functions[field] = df.Function(
+                        self.S_ref, name=field)
+                vf = self.extra_field_functions[field]
+                projector(ufl_expression, vf)
+                vf.rename(field, "tmp")
+            self.files[field].write(vf, tstep)
+
+    def _get_projector(self, method):
+        if method not in self.projectors:
+            self.projectors[method] = Projector(self.S_ref, method)
+        return self.projectors[method]
 
     def _unpack(self):
         num_fields = len(self.fields)
@@ -214,85 +446,193 @@ class Timeseries:
             return self.u_.split()
 
     def _create_file(self, filename):
+        if self.gatherer is not None:
+            series = self.shared
+            if self.shared is None and mpi_is_root():
+                series = XDMFSeries(filename, self.mesh_xdmf)
+            return GatheredFile(series, self.gatherer, self.writer)
         f = df.XDMFFile(mpi_comm(), "{}.xdmf".format(filename))
         f.parameters["rewrite_function_mesh"] = False
         f.parameters["flush_output"] = True
         return f
 
-    def close(self):
+    def flush(self):
+        """ Write buffered statistics and wait for pending asynchronous
+        output. """
+        for logger in self.stats.values():
+            logger.flush()
+        if self.writer is not None:
+            self.writer.flush()
+        mpi_barrier()
+
+    def checkpoint(self, tstep, t, mesh, w_, w_1, parameters, **kwargs):
+        """ Save a checkpoint in the results folder, see save_checkpoint,
+        after waiting for pending output. """
+        self.flush()
+        save_checkpoint(tstep, t, mesh, w_, w_1, self.folder, parameters,
+                        **kwargs)
+
+    def _close_output(self):
+        """ Close the files and finish pending output on this process.
+        Not collective, so that it can run at exit. """
+        for logger in self.stats.values():
+            logger.flush()
         for field in self.files.keys():
             self.files[field].close()
+        if self.writer is not None:
+            self.writer.close()
 
-    def add_field(self, ufl_expression, field_name):
+    def close(self):
+        self._close_output()
+        mpi_barrier()
+
+    def add_field(self, ufl_expression, field_name, method=None):
+        """ Add a field given by a UFL expression (or a list of them, for
+        vector fields), which is projected onto S_ref when dumped. method
+        is one of Projector.methods, and defaults to the projection method
+        of the Timeseries. """
         filename = os.path.join(self.folder, "Timeseries",
                                 "{}_from_tstep_{}".format(field_name,
                                                           self.tstep0))
         self.extra_fields[field_name] = ufl_expression
+        self.extra_field_methods[field_name] = (
+            self.projection if method is None else method)
         self.files[field_name] = self._create_file(filename)
 
     def get_function(self, field):
         return self.extra_field_functions[field]
 
-    def dump_stats(self, t, data_at_t, name):
+    def add_reducer(self, reducer, intv=1):
+        """ Register a Reducer (see surfaise.common.reductions), which is
+        evaluated every intv-th time step in reduce(). Its axes, if any,
+        are written to Statistics/<reducer.name>_<axis>.dat. """
+        self.reducers.append((reducer, intv))
         if mpi_is_root():
-            filename = os.path.join(self.folder, "Statistics",
-                                    "{}.dat".format(name))
-            data_at_t = np.array(data_at_t).flatten()
-            with open(filename, "a+") as outfile:
-                outfile.write("{}".format(t))
-                for d in data_at_t:
-                    outfile.write("\t {}".format(d))
-                outfile.write("\n")
-
-
-def save_checkpoint(tstep, t, mesh, w_, w_1, folder, parameters, name=""):
+            for axis, values in reducer.axes.items():
+                np.savetxt(os.path.join(
+                    self.folder, "Statistics",
+                    "{}_{}.dat".format(reducer.name, axis)), values)
+
+    def reduce(self, t, tstep):
+        """ Evaluate the registered reducers and log their output to
+        Statistics/<reducer.name>. """
+        for reducer, intv in self.reducers:
+            if tstep % intv == 0:
+                self.dump_stats(t, reducer(), reducer.name,
+                                columns=reducer.columns)
+
+    def dump_stats(self, t, data_at_t, name, columns=None):
+        """ Log the row (t, data_at_t...) to Statistics/<name>.npy, with
+        the given column names (c0, c1, ... by default). """
+        if name not in self.stats:
+            data_at_t = np.asarray(data_at_t).flatten()
+            if columns is None:
+                columns = ["c{}".format(i) for i in range(len(data_at_t))]
+            self.stats[name] = StatisticsLogger(
+                os.path.join(self.folder, "Statistics", name), columns,
+                buffer_size=self.stats_buffer_size,
+                text_export=self.stats_text_export)
+        self.stats[name].log(t, data_at_t)
+
+
+def checkpoint_mesh_file(checkpointfolder):
+    """ Returns the file containing the mesh of a checkpoint. """
+    filename = os.path.join(checkpointfolder, "mesh.h5")
+    if os.path.exists(filename):
+        return filename
+    # Checkpoints from earlier versions store the mesh with the fields.
+    return os.path.join(checkpointfolder, "fields.h5")
+
+
+def save_checkpoint(tstep, t, mesh, w_, w_1, folder, parameters, name="",
+                    extra_functions=None, num_slots=2):
     """ Save checkpoint files.
-    A part of this is taken from the Oasis code."""
+
+    The mesh is written to mesh.h5 once. The fields are written to the
+    next of num_slots rotating files fields_<slot>.h5, first to a
+    temporary file which is then atomically renamed. Finally,
+    parameters.dat, which records the slot, is replaced atomically; this
+    commits the checkpoint, so that a failure at any point leaves the
+    previous checkpoint intact.
+
+    w_1 may be None if the previous solution is not needed to restart;
+    load_checkpoint then sets w_1 to w_. extra_functions is an optional
+    dict of additional functions, e.g. the history of a multistep time
+    integrator, stored under their keys."""
     checkpointfolder = os.path.join(folder, "Checkpoint")
+
+    meshfilename = os.path.join(checkpointfolder, "mesh.h5")
+    if not mpi_comm().bcast(os.path.exists(meshfilename), root=0):
+        info_red("Storing mesh")
+        tmpfilename = meshfilename + ".tmp"
+        h5file = df.HDF5File(mpi_comm(), tmpfilename, "w")
+        h5file.write(mesh, "mesh")
+        h5file.close()
+        mpi_barrier()
+        if mpi_is_root():
+            os.replace(tmpfilename, meshfilename)
+
+    slot = (parameters.get("checkpoint_slot", -1) + 1) % num_slots
+    h5filename = os.path.join(checkpointfolder, "fields_{}.h5".format(slot))
+    tmpfilename = h5filename + ".tmp"
+    h5file = df.HDF5File(mpi_comm(), tmpfilename, "w")
+    info_red("Storing current solution")
+    h5file.write(w_, "{}/current".format(name))
+    if w_1 is not None:
+        info_red("Storing previous solution")
+        h5file.write(w_1, "{}/previous".format(name))
+    if extra_functions:
+        for key, f in extra_functions.items():
+            info_red("Storing {}".format(key))
+            h5file.write(f, "{}/{}".format(name, key))
+    h5file.close()
+    mpi_barrier()
+
     parameters["num_processes"] = mpi_size()
     parameters["t_0"] = t
     parameters["tstep"] = tstep
+    parameters["checkpoint_slot"] = slot
     parametersfile = os.path.join(checkpointfolder, "parameters.dat")
-    parametersfile_old = parametersfile + ".old"
     if mpi_is_root():
-        # In case of failure, keep old file.
-        if os.path.exists(parametersfile):
-            os.system("mv {0} {1}".format(parametersfile,
-                                          parametersfile_old))
-        dump_parameters(parameters, parametersfile)
-
-    mpi_barrier()
-    h5filename = os.path.join(checkpointfolder, "fields.h5")
-    h5filename_old = h5filename + ".old"
-    # In case of failure, keep old file.
-    if mpi_is_root() and os.path.exists(h5filename):
-        os.system("mv {0} {1}".format(h5filename, h5filename_old))
-    h5file = df.HDF5File(mpi_comm(), h5filename, "w")
-    h5file.flush()
-    info_red("Storing mesh")
-    h5file.write(mesh, "mesh")
+        os.replace(tmpfilename, h5filename)
+        dump_parameters(parameters, parametersfile + ".tmp")
+        os.replace(parametersfile + ".tmp", parametersfile)
     mpi_barrier()
-    info_red("Storing current solution")
-    h5file.write(w_, "{}/current".format(name))
-    info_red("Storing previous solution")
-    h5file.write(w_1, "{}/previous".format(name))
-    mpi_barrier()
-    h5file.close()
-    # Since program is still running, delete the old files.
-    remove_safe(h5filename_old)
-    mpi_barrier()
-    remove_safe(parametersfile_old)
 
 
-def load_checkpoint(checkpointfolder, w_, w_1, name=""):
+def load_checkpoint(checkpointfolder, w_, w_1, name="",
+                    extra_functions=None):
+    """ Load checkpoint files. Returns False if any of the functions in
+    extra_functions were not found in the checkpoint. """
+    found = True
     if checkpointfolder:
-        h5filename = os.path.join(checkpointfolder, "fields.h5")
+        parameters = dict()
+        load_parameters(parameters,
+                        os.path.join(checkpointfolder, "parameters.dat"))
+        if "checkpoint_slot" in parameters:
+            h5filename = os.path.join(checkpointfolder, "fields_{}.h5".format(
+                parameters["checkpoint_slot"]))
+        else:
+            h5filename = os.path.join(checkpointfolder, "fields.h5")
         h5file = df.HDF5File(mpi_comm(), h5filename, "r")
         info_red("Loading current solution")
         h5file.read(w_, "{}/current".format(name))
-        info_red("Loading previous solution")
-        h5file.read(w_1, "{}/previous".format(name))
+        if h5file.has_dataset("{}/previous".format(name)):
+            info_red("Loading previous solution")
+            h5file.read(w_1, "{}/previous".format(name))
+        else:
+            w_1.assign(w_)
+        if extra_functions:
+            for key, f in extra_functions.items():
+                dset = "{}/{}".format(name, key)
+                if h5file.has_dataset(dset):
+                    info_red("Loading {}".format(key))
+                    h5file.read(f, dset)
+                else:
+                    info_red("Could not find {} in checkpoint".format(key))
+                    found = False
         h5file.close()
+    return found
 
 
 def load_mesh(filename, subdir="mesh",
@@ -0,0 +1,212 @@
+import dolfin as df
+import numpy as np
+from mpi4py import MPI as pyMPI
+from .cmd import mpi_comm, mpi_max, mpi_min
+from .diagnostics import Functionals
+from .utilities import Projector
+
+
+class Reducer:
+    """ Base class for in-situ reductions of the live solution to a few
+    numbers. Subclasses set name and columns (and optionally axes, a dict
+    of named arrays describing the columns), and define __call__, which
+    returns one value per column. Register with Timeseries.add_reducer.
+    """
+    name = "reducer"
+    columns = []
+    axes = dict()
+
+
+class IntegralReducer(Reducer):
+    """ Surface integrals of a dict of scalar integrands, assembled in one
+    pass. """
+    def __init__(self, geo_map, integrands, name="integrals"):
+        self.name = name
+        self.functionals = Functionals(geo_map, integrands)
+        self.columns = self.functionals.names
+
+    def __call__(self):
+        values = self.functionals()
+        return [values[column] for column in self.columns]
+
+
+class _NodalReducer(Reducer):
+    """ Reducer working on the nodal values of a scalar expression on
+    S_ref, obtained by vertex quadrature. """
+    def __init__(self, geo_map, expr):
+        self.expr = expr
+        self.projector = Projector(geo_map.S_ref, "interpolate")
+        self.f = df.Function(geo_map.S_ref)
+
+    def values(self):
+        self.projector(self.expr, self.f)
+        return self.f.vector().get_local()
+
+
+class ExtremaReducer(_NodalReducer):
+    """ Minimum and maximum of a scalar expression. """
+    def __init__(self, geo_map, expr, name="extrema"):
+        _NodalReducer.__init__(self, geo_map, expr)
+        self.name = name
+        self.columns = ["min", "max"]
+
+    def __call__(self):
+        values = self.values()
+        return [mpi_min(np.append(values, np.inf)),
+                mpi_max(np.append(values, -np.inf))]
+
+
+class HistogramReducer(_NodalReducer):
+    """ Area weighted histogram of a scalar expression, with the given
+    bins (edges). Values outside the bins are not counted. """
+    def __init__(self, geo_map, expr, bins, name="histogram"):
+        _NodalReducer.__init__(self, geo_map, expr)
+        self.name = name
+        self.bins = np.asarray(bins, dtype=float)
+        self.columns = ["b{}".format(i) for i in range(len(self.bins)-1)]
+        v = df.TestFunction(geo_map.S_ref)
+        self.weights = df.assemble(geo_map.form(v)).get_local()
+
+    def __call__(self):
+        hist, _ = np.histogram(self.values(), bins=self.bins,
+                               weights=self.weights)
+        mpi_comm().Allreduce(pyMPI.IN_PLACE, hist, op=pyMPI.SUM)
+        return hist
+
+
+class StructureFactorReducer(_NodalReducer):
+    """ Structure factor S(k) of a scalar expression (typically psi), for
+    maps with a rectangular reference domain.
+
+    The field is resampled onto a uniform reference grid of the given
+    shape by a sparse P1 interpolation matrix, computed once. On the root
+    process, the mean is subtracted, the field is weighted by sqrt_g
+    (normalized), optionally multiplied by a Hann window (for non-periodic
+    maps), Fourier transformed, and |F|^2/N is averaged in num_bins radial
+    bins of |k| up to k_max, times num_angles bins of the direction of k.
+    Wavenumbers refer to the reference coordinates. The bin centers k
+    and the angle bin edges theta are given in axes, which Timeseries
+    writes to Statistics/<name>_k.dat and <name>_theta.dat.
+    """
+    def __init__(self, geo_map, expr, shape=None, num_bins=50, k_max=None,
+                 num_angles=1, window=False, name="structure_factor"):
+        _NodalReducer.__init__(self, geo_map, expr)
+        self.name = name
+        self.comm = mpi_comm()
+        self.mesh = geo_map.ref_mesh
+        t, s = geo_map.AXIS_REF
+        r_min = (geo_map.r_ref_min[t], geo_map.r_ref_min[s])
+        L = (geo_map.r_ref_max[t] - r_min[0], geo_map.r_ref_max[s] - r_min[1])
+        if shape is None:
+            N_t = int(np.sqrt(self.mesh.num_entities_global(0)*L[0]/L[1]))
+            shape = (N_t, int(N_t*L[1]/L[0]))
+        self.shape = tuple(shape)
+        T, S = np.meshgrid(r_min[0] + L[0]*np.arange(shape[0])/shape[0],
+                           r_min[1] + L[1]*np.arange(shape[1])/shape[1],
+                           indexing="ij")
+        points = np.vstack((T.ravel(), S.ravel())).T
+
+        self._build_interpolation(points)
+
+        num_cols = num_bins*num_angles
+        if num_angles == 1:
+            self.columns = ["S{}".format(i) for i in range(num_bins)]
+        else:
+            self.columns = ["S{}_{}".format(i, j) for i in range(num_bins)
+                            for j in range(num_angles)]
+
+        k_t = 2*np.pi*np.fft.fftfreq(shape[0], d=L[0]/shape[0])
+        k_s = 2*np.pi*np.fft.fftfreq(shape[1], d=L[1]/shape[1])
+        if k_max is None:
+            k_max = min(np.max(np.abs(k_t)), np.max(np.abs(k_s)))
+        self.k = k_max*(np.arange(num_bins) + 0.5)/num_bins
+        self.axes = dict(k=self.k,
+                         theta=np.linspace(0., np.pi, num_angles+1))
+
+        self.weight = None
+        if self.comm.rank == 0:
+            sqrt_g = geo_map.eval("sqrt_g", dict([(t, points[:, 0]),
+                                                  (s, points[:, 1])]))
+            self.weight = (sqrt_g/np.mean(sqrt_g)).reshape(self.shape)
+            if window:
+                self.weight = self.weight*np.outer(np.hanning(shape[0]),
+                                                   np.hanning(shape[1]))
+
+            K_t, K_s = np.meshgrid(k_t, k_s, indexing="ij")
+            k_abs = np.sqrt(K_t**2 + K_s**2).ravel()
+            i_k = np.floor(k_abs/k_max*num_bins).astype(int)
+            theta = np.mod(np.arctan2(K_s, K_t).ravel(), np.pi)
+            i_theta = np.minimum(
+                np.floor(theta/np.pi*num_angles).astype(int), num_angles-1)
+            self.bin_index = i_k*num_angles + i_theta
+            self.bin_index[np.logical_or(k_abs == 0., i_k >= num_bins)] = \
+                num_cols
+            self.bin_count = np.bincount(self.bin_index,
+                                         minlength=num_cols+1)[:num_cols]
+            self.bin_count[self.bin_count == 0] = 1
+        self.num_cols = num_cols
+
+    def _build_interpolation(self, points):
+        """ Sparse matrix from local vertex values to the grid points
+        found in the local cells. Each point is kept by the lowest rank
+        containing it. """
+        from scipy.sparse import csr_matrix
+        tree = self.mesh.bounding_box_tree()
+        num_cells = self.mesh.num_cells()
+        cells = self.mesh.cells()
+        x = self.mesh.coordinates()
+        found = []
+        rows = []
+        cols = []
+        vals = []
+        for i, point in enumerate(points):
+            cell = tree.compute_first_entity_collision(df.Point(*point))
+            if cell >= num_cells:
+                continue
+            vertices = cells[cell]
+            # Barycentric coordinates
+            A = np.vstack((x[vertices].T, np.ones(len(vertices))))
+            lam = np.linalg.solve(A, np.append(point, 1.))
+            rows.extend([len(found)]*len(vertices))
+            cols.extend(vertices)
+            vals.extend(lam)
+            found.append(i)
+        found = np.array(found, dtype=np.int64)
+
+        owner = np.full(len(points), self.comm.size, dtype=np.int32)
+        owner[found] = self.comm.rank
+        self.comm.Allreduce(pyMPI.IN_PLACE, owner, op=pyMPI.MIN)
+        keep = owner[found] == self.comm.rank
+
+        A = csr_matrix((vals, (rows, cols)),
+                       shape=(len(found), len(x)))
+        self.A = A[np.flatnonzero(keep), :]
+        self.grid_indices = found[keep]
+
+        self.counts = self.comm.gather(len(self.grid_indices), root=0)
+        self.all_indices = None
+        if self.comm.rank == 0:
+            self.all_indices = np.zeros(sum(self.counts), dtype=np.int64)
+            self.comm.Gatherv(self.grid_indices,
+                              (self.all_indices, self.counts), root=0)
+        else:
+            self.comm.Gatherv(self.grid_indices, None, root=0)
+
+    def __call__(self):
+        self.projector(self.expr, self.f)
+        local = np.ascontiguousarray(
+            self.A.dot(self.f.compute_vertex_values(self.mesh)))
+        if self.comm.rank != 0:
+            self.comm.Gatherv(local, None, root=0)
+            return np.zeros(self.num_cols)
+        recv = np.zeros(sum(self.counts))
+        self.comm.Gatherv(local, (recv, self.counts), root=0)
+        psi = np.zeros(self.shape[0]*self.shape[1])
+        psi[self.all_indices] = recv
+        psi = psi.reshape(self.shape)
+
+        psi = (psi - np.sum(self.weight*psi)/np.sum(self.weight))*self.weight
+        S = np.abs(np.fft.fft2(psi))**2/psi.size
+        return np.bincount(self.bin_index, weights=S.ravel(),
+                           minlength=self.num_cols+1)[:self.num_cols] \
+            / self.bin_count
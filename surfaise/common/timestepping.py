@@ -0,0 +1,151 @@
+import dolfin as df
+import numpy as np
+from .cmd import mpi_max, info_blue
+from .utilities import TimeStepSelector
+
+
+class AdaptiveTimeStepSelector(TimeStepSelector):
+    """ Time step selector with a PI step size controller.
+
+    After each attempted step, call adapt(err) with an estimate of the
+    local error (see the estimators below). The step is accepted if
+    err <= tol and all registered acceptance criteria hold, e.g. that the
+    energy does not increase. In both cases the step size for the next
+    attempt is assigned, limited by min_factor, max_factor, dt_min and
+    dt_max. After a rejection the step is not allowed to grow.
+    """
+    def __init__(self, value, tol=1e-3, order=1, dt_min=1e-10,
+                 dt_max=np.inf, safety=0.9, min_factor=0.2, max_factor=5.,
+                 k_I=None, k_P=None):
+        TimeStepSelector.__init__(self, value)
+        self.tol = tol
+        self.order = order
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.safety = safety
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.k_I = 0.7/(order+1) if k_I is None else k_I
+        self.k_P = 0.4/(order+1) if k_P is None else k_P
+        self.criteria = []
+        self.err_prev = None
+        self.rejected = False
+        self.dt_prev = value
+        self.num_accepted = 0
+        self.num_rejected = 0
+
+    def add_acceptance_criterion(self, criterion):
+        """ Register a function criterion() -> bool which must hold for a
+        step to be accepted. """
+        self.criteria.append(criterion)
+
+    def adapt(self, err=None):
+        """ Accept or reject the step just computed, given the error
+        estimate err (None if no estimate is available), and assign the
+        next step size. Returns True if the step is accepted. """
+        dt = self.get()
+        err_n = None if err is None else max(err/self.tol, 1e-10)
+        if err_n is not None and err_n > 1.:
+            accepted = False
+            factor = max(self.min_factor,
+                         self.safety*err_n**(-1./(self.order+1)))
+        elif not all([criterion() for criterion in self.criteria]):
+            accepted = False
+            factor = 1./self.chop_factor
+        else:
+            accepted = True
+            factor = 1.
+            if err_n is not None:
+                factor = self.safety*err_n**(-self.k_I)
+                if self.err_prev is not None:
+                    factor *= self.err_prev**self.k_P
+                self.err_prev = err_n
+            factor = min(max(factor, self.min_factor),
+                         1. if self.rejected else self.max_factor)
+
+        if accepted:
+            self.dt_prev = dt
+            self.rejected = False
+            self.num_accepted += 1
+        else:
+            if dt <= self.dt_min:
+                raise RuntimeError("Time step rejected at dt_min.")
+            self.rejected = True
+            self.num_rejected += 1
+            info_blue("Step rejected, err = {}.".format(err))
+        self.set(min(max(dt*factor, self.dt_min), self.dt_max))
+        return accepted
+
+    def chop(self):
+        """ Reject the step, e.g. when the solver failed to converge. """
+        self.rejected = True
+        self.num_rejected += 1
+        TimeStepSelector.chop(self)
+
+
+class ExtrapolationErrorEstimator:
+    """ Estimates the local error of a backward Euler step by comparing the
+    solution u_ to the linear extrapolation of u_1 and the stored u_2,
+    i.e. the explicit predictor of an embedded BE/AB2 pair. Their
+    difference is u''*dt*(2*dt + dt_1)/2, and the BE local error is
+    u''*dt^2/2, hence the scaling by dt/(2*dt + dt_1).
+
+    Call update() after each accepted step, before u_1 is overwritten.
+    Returns None until enough history is available.
+    """
+    def __init__(self, u_, u_1, dt):
+        self.u_ = u_
+        self.u_1 = u_1
+        self.dt = dt
+        self.u_2 = df.Function(u_1.function_space(), name="u_2")
+        self.dt_1 = None
+
+    def __call__(self):
+        if self.dt_1 is None:
+            return None
+        dt = self.dt.get()
+        omega = dt/self.dt_1
+        u_pred = ((1 + omega)*self.u_1.vector().get_local()
+                  - omega*self.u_2.vector().get_local())
+        diff = np.abs(self.u_.vector().get_local() - u_pred)
+        return dt/(2*dt + self.dt_1)*mpi_max(np.append(diff, 0.))
+
+    def update(self):
+        self.u_2.assign(self.u_1)
+        self.dt_1 = self.dt.dt_prev
+
+
+class StepDoublingErrorEstimator:
+    """ Estimates the local error by step doubling: the step is recomputed
+    as two half steps by calling solve(), which must solve for u_ given
+    u_1 and the current dt. The more accurate two-step solution is left in
+    u_.
+    """
+    def __init__(self, u_, u_1, dt, solve, order=1):
+        self.u_ = u_
+        self.u_1 = u_1
+        self.dt = dt
+        self.solve = solve
+        self.order = order
+        self.u_full = df.Function(u_.function_space())
+        self.u_1_copy = df.Function(u_1.function_space())
+
+    def __call__(self):
+        dt = self.dt.get()
+        self.u_full.assign(self.u_)
+        self.u_1_copy.assign(self.u_1)
+        try:
+            self.dt.set(dt/2)
+            self.u_.assign(self.u_1)
+            self.solve()
+            self.u_1.assign(self.u_)
+            self.solve()
+        finally:
+            self.u_1.assign(self.u_1_copy)
+            self.dt.set(dt)
+        diff = np.abs(self.u_.vector().get_local()
+                      - self.u_full.vector().get_local())
+        return mpi_max(np.append(diff, 0.))/(2**self.order - 1)
+
+    def update(self):
+        pass
@@ -52,6 +52,58 @@ class AssignedTensorFunction(df.Function):
             self.fa[ij].assign(self.sub(ij), _u)
 
 
+class Projector:
+    """ Projection of UFL expressions onto the scalar space S, reusing the
+    mass matrix, the linear solver and the compiled right-hand side forms
+    across calls.
+
+    Methods:
+        "project":     L2 projection, the mass matrix is factorized once.
+        "lumped":      L2 projection with a lumped mass matrix.
+        "interpolate": Vertex quadrature, which for P1 gives the
+                       (cell averaged) values of the expression at the dofs.
+    """
+    methods = ("project", "lumped", "interpolate")
+
+    def __init__(self, S, method="project"):
+        if method not in self.methods:
+            raise ValueError("Unknown projection method: {}".format(method))
+        self.S = S
+        self.method = method
+        self.v = df.TestFunction(S)
+        if method == "interpolate":
+            self.dx = df.dx(S.mesh(), scheme="vertex", degree=1,
+                            metadata={"representation": "quadrature"})
+        else:
+            self.dx = df.dx(S.mesh())
+        if method == "project":
+            u = df.TrialFunction(S)
+            self.M = df.PETScMatrix()
+            df.assemble(u*self.v*self.dx, tensor=self.M)
+            self.solver = df.PETScLUSolver(self.M)
+        else:
+            self.M_inv = 1./df.assemble(self.v*self.dx).get_local()
+        self.b = df.PETScVector()
+        self.forms = dict()
+
+    def form(self, expr):
+        if expr not in self.forms:
+            self.forms[expr] = df.Form(expr*self.v*self.dx)
+        return self.forms[expr]
+
+    def __call__(self, expr, f=None):
+        """ Project expr into f (a new function on S if not given). """
+        if f is None:
+            f = df.Function(self.S)
+        df.assemble(self.form(expr), tensor=self.b)
+        if self.method == "project":
+            self.solver.solve(f.vector(), self.b)
+        else:
+            f.vector().set_local(self.M_inv*self.b.get_local())
+            f.vector().apply("insert")
+        return f
+
+
 class QuarticPotential:
     def __init__(self):
         self.Psi, self.Tau = sp.symbols('psi tau', real=True)
@@ -0,0 +1,329 @@
+import os
+import threading
+import queue
+import numpy as np
+import h5py
+from .cmd import mpi_comm, mpi_is_root
+from surfaise.utilities.xdmf_utils import (
+    header, grid_1st_begin, grid_ref_begin, mesh_1st, mesh_ref, timestamp,
+    grid_end, footer, attrib_template, attrib_slab, parse_xyz_xdmf)
+
+
+class VertexGatherer:
+    """ Gathers vertex values of functions on mesh to the root process, in
+    global vertex order, i.e. the node order of the mesh written by
+    df.XDMFFile. Vectors are padded to 3 and 2x2 tensors to 3x3 components,
+    as in df.XDMFFile.
+    """
+    def __init__(self, mesh):
+        self.comm = mpi_comm()
+        self.mesh = mesh
+        self.num_vertices = mesh.num_entities_global(0)
+        self.global_indices = np.asarray(
+            mesh.topology().global_indices(0), dtype=np.int64)
+        counts = self.comm.gather(len(self.global_indices), root=0)
+        self.counts = counts
+        self.indices = None
+        if mpi_is_root():
+            self.indices = np.zeros(sum(counts), dtype=np.int64)
+            self.comm.Gatherv(self.global_indices, (self.indices, counts),
+                              root=0)
+        else:
+            self.comm.Gatherv(self.global_indices, None, root=0)
+
+    def gather(self, f):
+        """ Returns the array of vertex values of f, of shape
+        (num_vertices, num_components), on root and None elsewhere. """
+        value_shape = f.ufl_shape
+        num_values = int(np.prod(value_shape)) if value_shape else 1
+        values = f.compute_vertex_values(self.mesh).reshape(
+            (num_values, -1)).T
+        if len(value_shape) == 1 and num_values < 3:
+            values = np.hstack((values, np.zeros(
+                (values.shape[0], 3-num_values))))
+        elif len(value_shape) == 2 and value_shape[0] < 3:
+            d = value_shape[0]
+            padded = np.zeros((values.shape[0], 3, 3))
+            padded[:, :d, :d] = values.reshape((-1, d, d))
+            values = padded.reshape((-1, 9))
+        return self.gather_values(values)
+
+    def gather_values(self, values):
+        """ Gather an array of values at the local vertices. """
+        values = np.ascontiguousarray(values, dtype=float)
+        ncomp = values.shape[1]
+        if mpi_is_root():
+            recv = np.zeros((sum(self.counts), ncomp))
+            self.comm.Gatherv(values, (recv, [c*ncomp for c in self.counts]),
+                              root=0)
+            out = np.zeros((self.num_vertices, ncomp))
+            out[self.indices, :] = recv
+            return out
+        self.comm.Gatherv(values, None, root=0)
+        return None
+
+    def gather_mesh(self):
+        """ Returns the vertex coordinates and the cells (in global vertex
+        indices) on root, and None elsewhere. """
+        coordinates = self.gather_values(self.mesh.coordinates())
+        tdim = self.mesh.topology().dim()
+        num_owned = self.mesh.topology().ghost_offset(tdim)
+        cells = self.global_indices[self.mesh.cells()[:num_owned]]
+        cells = self.comm.gather(cells, root=0)
+        if mpi_is_root():
+            return coordinates, np.concatenate(cells)
+        return None, None
+
+
+class XDMFSeries:
+    """ Time series of vertex values, written by the root process only to
+    filename.h5 and filename.xdmf in the layout of df.XDMFFile. The mesh is
+    referenced from an existing xdmf file (e.g. Geometry/xyz.xdmf). The
+    xdmf file is kept valid after every write.
+    """
+    def __init__(self, filename, mesh_xdmf):
+        self.h5filename = filename + ".h5"
+        self.xdmffilename = filename + ".xdmf"
+        (geometry_address, topology_address, _,
+         geometry_shape, topology_shape, _,
+         topology_type, nodes_per_element) = parse_xyz_xdmf(mesh_xdmf)
+        mesh_folder = os.path.relpath(os.path.dirname(mesh_xdmf),
+                                      os.path.dirname(self.xdmffilename))
+        self.keys = dict(
+            name="TimeSeries",
+            num_vert=geometry_shape[0],
+            num_elem=topology_shape[0],
+            xyz_filename=os.path.join(mesh_folder, geometry_address[0]),
+            xyz_loc=geometry_address[1],
+            topology_filename=os.path.join(mesh_folder, topology_address[0]),
+            topology_loc=topology_address[1],
+            topology_type=topology_type,
+            nodes_per_element=nodes_per_element,
+            geometry_type="XYZ" if geometry_shape[1] == 3 else "XY",
+            geometry_dim=geometry_shape[1])
+        self.h5file = h5py.File(self.h5filename, "w")
+        self.xdmffile = open(self.xdmffilename, "w")
+        self.xdmffile.write(header.format(**self.keys))
+        self.pos = self.xdmffile.tell()
+        self.count = 0
+        self.closed = False
+
+    def write(self, field, values, time):
+        loc = "/VisualisationVector/{}".format(self.count)
+        self.h5file.create_dataset(loc, data=values)
+        self.h5file.flush()
+
+        field_type = {1: "Scalar", 3: "Vector", 9: "Tensor"}[values.shape[1]]
+        if self.count == 0:
+            text = grid_1st_begin + mesh_1st.format(**self.keys)
+        else:
+            text = grid_ref_begin + mesh_ref.format(**self.keys)
+        text += timestamp.format(time=time)
+        text += attrib_template(field_type).format(
+            field=field, field_filename=os.path.basename(self.h5filename),
+            field_loc=loc, **self.keys)
+        text += grid_end
+
+        self.xdmffile.seek(self.pos)
+        self.xdmffile.write(text)
+        self.pos = self.xdmffile.tell()
+        self.xdmffile.write(footer)
+        self.xdmffile.truncate()
+        self.xdmffile.flush()
+        self.count += 1
+
+    def close(self):
+        if not self.closed:
+            self.h5file.close()
+            self.xdmffile.close()
+            self.closed = True
+
+
+class AsyncWriter:
+    """ Executes write tasks in order in a background thread. The queue is
+    bounded, so that submit blocks when output falls behind. Errors in the
+    thread are raised on the next call to submit or flush. After close,
+    submitted tasks are executed directly.
+    """
+    def __init__(self, maxsize=4):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                break
+            func, args = task
+            try:
+                if self.error is None:
+                    func(*args)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args):
+        self._check()
+        if self.closed:
+            func(*args)
+        else:
+            self.queue.put((func, args))
+
+    def flush(self):
+        """ Wait until all submitted tasks are done. """
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.closed = True
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+
+class SharedMeshSeries:
+    """ Time series of vertex values of several fields, written by the root
+    process only to a single HDF5 file:
+
+        /Mesh/geometry, /Mesh/topology    Written once.
+        /Fields/<field>                   (num_steps, num_vertices, ncomp)
+        /Time/<field>                     (num_steps,)
+
+    The field datasets are extendable and chunked by step, optionally
+    compressed ("gzip" or "lzf") and stored in single precision. Fields
+    are keyed by name, and each has its own step count and times; there
+    is no step table across fields. Writes with the same time as the
+    previous one are grouped in one grid of the accompanying xdmf file,
+    which addresses each step as a hyperslab. Grids are appended before
+    the footer, and only the last grid is rewritten when a field is added
+    to it. The dataset dimensions in a grid are those at the time it was
+    written, which remain a valid bound for its hyperslab as the dataset
+    grows.
+    """
+    def __init__(self, filename, coordinates, cells, topology_type,
+                 compression=None, single_precision=False):
+        self.h5filename = filename + ".h5"
+        self.xdmffilename = filename + ".xdmf"
+        self.compression = compression
+        self.dtype = np.float32 if single_precision else np.float64
+        self.precision = 4 if single_precision else 8
+
+        self.h5file = h5py.File(self.h5filename, "w")
+        self.h5file.create_dataset("Mesh/geometry", data=coordinates)
+        self.h5file.create_dataset("Mesh/topology",
+                                   data=np.asarray(cells, dtype=np.int64))
+        h5name = os.path.basename(self.h5filename)
+        self.keys = dict(
+            name="TimeSeries",
+            num_vert=coordinates.shape[0],
+            num_elem=cells.shape[0],
+            xyz_filename=h5name,
+            xyz_loc="/Mesh/geometry",
+            topology_filename=h5name,
+            topology_loc="/Mesh/topology",
+            topology_type=topology_type,
+            nodes_per_element=cells.shape[1],
+            geometry_type="XYZ" if coordinates.shape[1] == 3 else "XY",
+            geometry_dim=coordinates.shape[1])
+        self.fields = dict()
+        self.time = None
+        self.grid = ""
+        self.count = 0
+
+        self.xdmffile = open(self.xdmffilename, "w")
+        self.xdmffile.write(header.format(**self.keys))
+        self.pos = self.xdmffile.tell()
+        self.grid_end = self.pos
+        self.closed = False
+
+    def write(self, field, values, time):
+        num_vert, ncomp = values.shape
+        if field not in self.fields:
+            self.fields[field] = (
+                self.h5file.create_dataset(
+                    "Fields/" + field, shape=(0, num_vert, ncomp),
+                    maxshape=(None, num_vert, ncomp),
+                    chunks=(1, num_vert, ncomp), dtype=self.dtype,
+                    compression=self.compression),
+                self.h5file.create_dataset(
+                    "Time/" + field, shape=(0,), maxshape=(None,),
+                    dtype=np.float64))
+        dset, tdset = self.fields[field]
+        index = dset.shape[0]
+        dset.resize(index+1, axis=0)
+        dset[index] = values
+        tdset.resize(index+1, axis=0)
+        tdset[index] = time
+        self.h5file.flush()
+
+        self.write_xdmf(field, index, ncomp, time)
+
+    def write_xdmf(self, field, index, ncomp, time):
+        field_types = {1: "Scalar", 3: "Vector", 9: "Tensor"}
+        if self.time != time:
+            # Start a new grid after the last one
+            self.pos = self.grid_end
+            self.time = time
+            if self.count == 0:
+                self.grid = grid_1st_begin + mesh_1st.format(**self.keys)
+            else:
+                self.grid = grid_ref_begin + mesh_ref.format(**self.keys)
+            self.grid += timestamp.format(time=time)
+            self.count += 1
+        else:
+            self.grid = self.grid[:-len(grid_end)]
+        self.grid += attrib_slab.format(
+            field=field, field_type=field_types[ncomp],
+            index=index, ncomp=ncomp, num_steps=index+1,
+            precision=self.precision,
+            field_filename=os.path.basename(self.h5filename),
+            field_loc="/Fields/" + field, **self.keys)
+        self.grid += grid_end
+
+        self.xdmffile.seek(self.pos)
+        self.xdmffile.write(self.grid)
+        self.grid_end = self.xdmffile.tell()
+        self.xdmffile.write(footer)
+        self.xdmffile.truncate()
+        self.xdmffile.flush()
+
+    def close(self):
+        if not self.closed:
+            self.h5file.close()
+            self.xdmffile.close()
+            self.closed = True
+
+
+class GatheredFile:
+    """ Replacement for df.XDMFFile.write(f, t) which gathers the vertex
+    values of f to root and writes them to series (an XDMFSeries or a
+    SharedMeshSeries), through the AsyncWriter writer if given. """
+    def __init__(self, series, gatherer, writer=None):
+        self.series = series
+        self.gatherer = gatherer
+        self.writer = writer
+
+    def write(self, f, t):
+        values = self.gatherer.gather(f)
+        if mpi_is_root():
+            self._call(self.series.write, f.name(), values, float(t))
+
+    def close(self):
+        if mpi_is_root():
+            self._call(self.series.close)
+
+    def _call(self, func, *args):
+        if self.writer is not None:
+            self.writer.submit(func, *args)
+        else:
+            func(*args)
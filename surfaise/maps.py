@@ -5,10 +5,11 @@ from .bcs import EllipsoidPBC, CylinderPBC, TorusPBC
 from .common.mesh_refinement import densified_ellipsoid_mesh
 from .common.utilities import NdFunction, AssignedTensorFunction, \
     determinant, inverse
-from .common.io import load_mesh
+from .common.io import load_mesh, checkpoint_mesh_file
 from .common.cmd import info_red, info_cyan, info_blue
 from itertools import product
 import os
+import copy
 import ufl
 import mshr
 import cloudpickle as pickle
@@ -164,18 +165,22 @@ class GeoMap:
                         - self.map["g_" + k + l + "," + m])
                      for m in self.AXIS_REF])
 
-    def eval(self, key):
+    def eval(self, key, r_ref_vals=None):
+        """ Evaluate a geometric quantity at the dofs of the reference
+        space, or at the reference coordinates given in r_ref_vals. """
         if key not in self.evalf:
             self.info_verbose("Lambdifying: {}".format(key))
             self.evalf[key] = sp.lambdify(
                 [self.r_ref[j] for j in self.AXIS_REF],
                 self.map[key], "numpy")
 
+        if r_ref_vals is None:
+            r_ref_vals = self.r_ref_vals
         # v = self.evalf[key](self.t_vals, self.s_vals)
-        v = self.evalf[key](*[self.r_ref_vals[j] for j in self.AXIS_REF])
+        v = self.evalf[key](*[r_ref_vals[j] for j in self.AXIS_REF])
         if isinstance(v, int) or isinstance(v, float):
             # length = len(self.t_vals)
-            length = len(self.r_ref_vals[self.AXIS_REF[0]])
+            length = len(r_ref_vals[self.AXIS_REF[0]])
             return v*np.ones(length)
         else:
             return v
@@ -191,7 +196,7 @@ class GeoMap:
         f.vector()[:] = F
         return f
 
-    def initialize(self, res, restart_folder=None):
+    def initialize(self, res, restart_folder=None, num_levels=1):
         if restart_folder is not None:
             evalf_filename = os.path.join(restart_folder, "evalf.pkl")
             if os.path.exists(evalf_filename):
@@ -204,23 +209,61 @@ class GeoMap:
                 with open(map_filename, "rb") as f:
                     self.map = pickle.load(f)
         self.compute_geometry()
+        self.res = res
+        self.ref_meshes = []
+        self._levels = None
         if restart_folder is None:
-            self.compute_mesh(res)
-            self.compute_pbc()
-            isgood = False
-            while not isgood:
+            self.compute_mesh_hierarchy(res, num_levels)
+            if num_levels > 1:
                 self.initialize_ref_space(res)
                 self.initialize_metric()
-                isgood = self.recompute_mesh(res)
         else:
+            if num_levels > 1:
+                # Coarse levels are regenerated; the finest is loaded.
+                self.compute_mesh_hierarchy(res, num_levels)
             info_red("Load mesh from checkpoint")
-            self.ref_mesh = load_mesh(os.path.join(restart_folder,
-                                                   "fields.h5"),
+            self.ref_mesh = load_mesh(checkpoint_mesh_file(restart_folder),
                                       use_partition_from_file=True)
+            self.ref_meshes = self.ref_meshes[:-1] + [self.ref_mesh]
             self.compute_pbc()
             self.initialize_ref_space(res)
             self.initialize_metric()
 
+    def compute_mesh_hierarchy(self, res, num_levels=1):
+        """ Build nested reference meshes by uniform refinement of a
+        coarse mesh. The finest level becomes the reference mesh. """
+        res_coarse = res // 2**(num_levels-1)
+        assert(res_coarse > 0)
+        self.compute_mesh(res_coarse)
+        self.compute_pbc()
+        isgood = False
+        while not isgood:
+            self.initialize_ref_space(res_coarse)
+            self.initialize_metric()
+            isgood = self.recompute_mesh(res_coarse)
+        self.ref_meshes = [self.ref_mesh]
+        for _ in range(num_levels-1):
+            self.ref_mesh = df.refine(self.ref_mesh)
+            self.ref_meshes.append(self.ref_mesh)
+
+    def levels(self):
+        """ Returns copies of the map bound to each reference mesh in the
+        hierarchy, ordered from coarsest to finest. The geometric
+        coefficients are evaluated at the nodes of each level. """
+        if self._levels is None:
+            self._levels = []
+            for level, mesh in enumerate(self.ref_meshes[:-1]):
+                res_level = self.res // 2**(len(self.ref_meshes)-1-level)
+                geo_map = copy.copy(self)
+                geo_map.ref_mesh = mesh
+                geo_map.ref_meshes = self.ref_meshes[:level+1]
+                geo_map._levels = None
+                geo_map.initialize_ref_space(res_level)
+                geo_map.initialize_metric()
+                self._levels.append(geo_map)
+            self._levels.append(self)
+        return self._levels
+
     def _dot_pointwise(self, a, b, key):
         self.info_verbose("Computing pointwise: {}".format(key))
         f = self.make_function(key)
@@ -519,6 +562,40 @@ class GeoMap:
     def is_periodic_in_3d(self):
         return False
 
+    def is_double_periodic(self):
+        """ Whether the reference domain is periodic in both directions. """
+        return False
+
+    def averaged(self):
+        """ Returns a copy of the map where the geometric quantities are
+        replaced by constants, averaged over the reference domain, i.e. a
+        flat approximation of the surface. """
+        area_ref = df.assemble(df.Constant(1.)*self.dS_ref)
+        area = df.assemble(self.form(df.Constant(1.)))
+
+        def mean(f):
+            return df.assemble(self.form(f))/area
+
+        def mean_tensor(T, rank=2):
+            shape = (self.dim_ref,)*rank
+            return df.Constant(np.reshape(
+                [mean(T[ij]) for ij in product(*[range(d) for d in shape])],
+                shape))
+
+        geo_map = copy.copy(self)
+        geo_map._levels = None
+        geo_map.sqrt_g = df.Constant(area/area_ref)
+        geo_map.g_ab = mean_tensor(self.g_ab)
+        geo_map.gab = mean_tensor(self.gab)
+        if self.dim_ref <= 2:
+            geo_map.K = df.Constant(mean(self.K))
+            geo_map.H = df.Constant(mean(self.H))
+            geo_map.K_ab = mean_tensor(self.K_ab)
+            geo_map.Ka_b = mean_tensor(self.Ka_b)
+            geo_map.Kab = mean_tensor(self.Kab)
+        geo_map.Ga_bc = df.Constant(np.zeros((self.dim_ref,)*3))
+        return geo_map
+
     def info_verbose(self, message):
         if self.verbose:
             info_cyan(message)
@@ -618,6 +695,9 @@ class CylinderMap(GeoMap):
     def is_periodic_in_3d(self):
         return self.double_periodic
 
+    def is_double_periodic(self):
+        return self.double_periodic
+
 
 class GaussianBumpMap(GeoMap):
     def __init__(self, Lx, Ly, h, sigma, verbose=False):
@@ -680,6 +760,9 @@ class GaussianBumpMapPBC(GeoMap):
     def is_periodic_in_3d(self):
         return self.double_periodic
 
+    def is_double_periodic(self):
+        return self.double_periodic
+
 
 class GaussianBumpMapRound(GeoMap):
     def __init__(self, R, h, sigma, verbose=False):
@@ -829,6 +912,9 @@ class RoughMap(GeoMap):
     def is_periodic_in_3d(self):
         return self.double_periodic
 
+    def is_double_periodic(self):
+        return self.double_periodic
+
 
 class SaddleMapRound(GeoMap):
     def __init__(self, R, a, b):
@@ -884,6 +970,9 @@ class TorusMap(GeoMap):
         # ts_max = (self.t_max, self.s_max)
         self.pbc = TorusPBC(ts_min, ts_max)
 
+    def is_double_periodic(self):
+        return True
+
     def compute_mesh(self, res):
         factor = np.sqrt(self.R/self.r)
         Nt = int(res/factor)
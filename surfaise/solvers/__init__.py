@@ -0,0 +1,16 @@
+from .multigrid import GeometricMultigrid
+from .fourier import PeriodicGrid, FourierPreconditioner
+from .spectral_pfc import SpectralPFC
+from .integrators import TimeIntegrator
+from .navier_stokes import SurfaceIPCS
+from .cahn_hilliard import CahnHilliardSolver
+
+__all__ = [
+    "GeometricMultigrid",
+    "PeriodicGrid",
+    "FourierPreconditioner",
+    "SpectralPFC",
+    "TimeIntegrator",
+    "SurfaceIPCS",
+    "CahnHilliardSolver",
+]
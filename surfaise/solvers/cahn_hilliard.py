@@ -0,0 +1,80 @@
+import dolfin as df
+from surfaise.common.utilities import QuarticPotential
+from surfaise.common.cmd import info_cyan
+from .navier_stokes import _constant
+
+
+class CahnHilliardSolver:
+    """ Linearly stabilized scheme for the surface Cahn-Hilliard equation
+
+        dc/dt = div(M grad mu),
+        mu = w'(c) - eps^2 Laplace(c),
+
+    with the quartic potential w(c) = tau/2 c^2 + c^4/4. The potential is
+    treated explicitly with the stabilization S (c_ - c_1), which is
+    energy stable for S >= max w''(c)/2. The bilinear form is then
+    independent of the solution: its matrix is assembled and factorized
+    once per dt, and each step assembles a single right-hand side form.
+
+    The unknowns (c, mu) are kept in the mixed function u_. Unless
+    linear_solver is "lu", the coupled system is solved with the given
+    Krylov method and preconditioner. The default preconditioner is
+    PETSc's (ILU, block Jacobi with ILU in parallel), which suits this
+    block system since both diagonal blocks are mass matrices.
+    """
+    def __init__(self, geo_map, eps=1., M=1., tau=-1., dt=1e-2, S=2.,
+                 linear_solver="lu", preconditioner="default"):
+        self.geo_map = geo_map
+        self.eps = _constant(eps)
+        self.M = _constant(M)
+        self.tau = _constant(tau)
+        self.dt = _constant(dt)
+        self.S = _constant(S)
+        self.w = QuarticPotential()
+
+        self.W = geo_map.mixed_space(2)
+        self.u_ = df.Function(self.W, name="u_")
+        self.u_1 = df.Function(self.W, name="u_1")
+
+        c, mu = df.TrialFunctions(self.W)
+        chi, xi = df.TestFunctions(self.W)
+        c_, mu_ = df.split(self.u_)
+        c_1, mu_1 = df.split(self.u_1)
+
+        self.a = geo_map.form(
+            c*chi + self.dt*self.M*geo_map.dotgrad(mu, chi)
+            + mu*xi - self.S*c*xi - self.eps**2*geo_map.dotgrad(c, xi))
+        self.L = geo_map.form(
+            c_1*chi
+            + (self.w.f_dw(c_1, self.tau) - self.S*c_1)*xi)
+        self.E = geo_map.form(self.eps**2/2*geo_map.dotgrad(c_, c_)
+                              + self.w(c_, self.tau))
+
+        self.A = df.PETScMatrix()
+        self.b = df.PETScVector()
+        if linear_solver == "lu":
+            self.solver = df.PETScLUSolver()
+        else:
+            if not df.has_krylov_solver_preconditioner(preconditioner):
+                preconditioner = "default"
+            self.solver = df.PETScKrylovSolver(linear_solver, preconditioner)
+            self.solver.parameters["nonzero_initial_guess"] = True
+        self.dt_assembled = None
+
+    def _assemble_matrix(self):
+        info_cyan("Assembling Cahn-Hilliard matrix")
+        df.assemble(self.a, tensor=self.A)
+        self.solver.set_operator(self.A)
+        self.dt_assembled = float(self.dt)
+
+    def step(self):
+        """ Advance u_ by one time step. """
+        if self.dt_assembled != float(self.dt):
+            self._assemble_matrix()
+        self.u_1.assign(self.u_)
+        df.assemble(self.L, tensor=self.b)
+        self.solver.solve(self.u_.vector(), self.b)
+
+    def energy(self):
+        """ Free energy of the current state. """
+        return df.assemble(self.E)
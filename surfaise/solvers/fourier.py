@@ -0,0 +1,187 @@
+import dolfin as df
+import numpy as np
+from surfaise.common.cmd import mpi_comm, mpi_is_root, info_cyan
+
+
+class PeriodicGrid:
+    """ Maps the dofs of a (possibly mixed) P1 space on a structured,
+    doubly periodic reference mesh to a uniform grid.
+
+    Grid arrays have the shape (num_fields, Nt, Ns) and live on the root
+    process only.
+    """
+    def __init__(self, V, geo_map):
+        if not geo_map.is_double_periodic():
+            raise ValueError("PeriodicGrid requires a doubly periodic map.")
+        self.comm = mpi_comm()
+        t, s = geo_map.AXIS_REF
+        self.r_min = (geo_map.r_ref_min[t], geo_map.r_ref_min[s])
+        self.L = (geo_map.r_ref_max[t] - geo_map.r_ref_min[t],
+                  geo_map.r_ref_max[s] - geo_map.r_ref_min[s])
+
+        if V.num_sub_spaces() == 0:
+            subspaces = [V]
+        else:
+            subspaces = [V.sub(i) for i in range(V.num_sub_spaces())]
+        self.num_fields = len(subspaces)
+
+        first, last = V.dofmap().ownership_range()
+        self.local_size = last - first
+        x = V.tabulate_dof_coordinates().reshape((-1, geo_map.dim_ref))
+
+        local = []
+        fields = []
+        for field, Vi in enumerate(subspaces):
+            dofs = np.asarray(Vi.dofmap().dofs(), dtype=int)
+            dofs = dofs[np.logical_and(dofs >= first, dofs < last)]
+            local.append(dofs - first)
+            fields.append(field*np.ones(len(dofs), dtype=int))
+        self.local = np.concatenate(local)
+        fields = np.concatenate(fields)
+        x_loc = x[self.local, :]
+
+        gathered = self.comm.gather((self.local + first, fields, x_loc),
+                                    root=0)
+        self.shape = None
+        if mpi_is_root():
+            dofs = np.concatenate([g[0] for g in gathered])
+            fields = np.concatenate([g[1] for g in gathered])
+            x = np.concatenate([g[2] for g in gathered])
+            self.counts = [len(g[0]) for g in gathered]
+
+            N = []
+            for d in range(2):
+                xd = np.sort(x[fields == 0, d])
+                tol = 1e-8*self.L[d]
+                N.append(1 + int(np.sum(np.diff(xd) > tol)))
+            if N[0]*N[1] != np.sum(fields == 0):
+                raise ValueError("The reference mesh is not structured.")
+            self.shape = tuple(N)
+
+            self.fields = fields
+            self.indices = [
+                np.round((x[:, d] - self.r_min[d])*N[d]/self.L[d]).astype(
+                    int) % N[d] for d in range(2)]
+            self.dofs = dofs
+        self.shape = self.comm.bcast(self.shape, root=0)
+
+    def gather(self, values):
+        """ Gather the owned dof values of a vector into a grid array on the
+        root process. """
+        recv = None
+        if mpi_is_root():
+            recv = np.zeros(sum(self.counts))
+        sendbuf = np.ascontiguousarray(values[self.local], dtype=float)
+        if mpi_is_root():
+            self.comm.Gatherv(sendbuf, (recv, self.counts), root=0)
+            grid = np.zeros((self.num_fields,) + self.shape)
+            grid[self.fields, self.indices[0], self.indices[1]] = recv
+            return grid
+        self.comm.Gatherv(sendbuf, None, root=0)
+        return None
+
+    def scatter(self, grid):
+        """ Scatter a grid array on the root process to the owned dof values
+        of a vector. """
+        sendbuf = None
+        if mpi_is_root():
+            sendbuf = (np.ascontiguousarray(
+                grid[self.fields, self.indices[0], self.indices[1]],
+                dtype=float), self.counts)
+        recv = np.zeros(len(self.local))
+        self.comm.Scatterv(sendbuf, recv, root=0)
+        values = np.zeros(self.local_size)
+        values[self.local] = recv
+        return values
+
+    def wavenumbers(self):
+        """ Wavenumbers along the two reference axes, in the layout of
+        numpy.fft.rfft2. """
+        k_t = 2*np.pi*np.fft.fftfreq(self.shape[0], d=self.L[0]/self.shape[0])
+        k_s = 2*np.pi*np.fft.rfftfreq(self.shape[1],
+                                      d=self.L[1]/self.shape[1])
+        return np.meshgrid(k_t, k_s, indexing="ij")
+
+    def coordinates(self):
+        """ Reference coordinates of the grid points. """
+        t = self.r_min[0] + self.L[0]*np.arange(self.shape[0])/self.shape[0]
+        s = self.r_min[1] + self.L[1]*np.arange(self.shape[1])/self.shape[1]
+        return np.meshgrid(t, s, indexing="ij")
+
+
+class FourierPreconditioner:
+    """ Preconditioner for doubly periodic maps, based on a
+    constant-coefficient approximation of the operator which is inverted
+    by FFTs on the structured dof grid.
+
+    The bilinear form a_flat must be defined on V with constant
+    coefficients, typically by building the same form as the full problem
+    from geo_map.averaged(). Nonlinear terms should be replaced by a
+    constant linearization. On a structured periodic mesh the assembled
+    operator is then block circulant, and its symbol is read off from the
+    stencil of a single row per field.
+    """
+    def __init__(self, V, a_flat, geo_map):
+        self.grid = PeriodicGrid(V, geo_map)
+        nf = self.grid.num_fields
+        Nt, Ns = self.grid.shape
+
+        A = df.PETScMatrix()
+        df.assemble(a_flat, tensor=A)
+
+        self.symbol_inv = None
+        if mpi_is_root():
+            info_cyan("Computing Fourier symbol of the flat operator")
+            position = -np.ones(np.max(self.grid.dofs)+1, dtype=int)
+            position[self.grid.dofs] = np.arange(len(self.grid.dofs))
+            num_local = self.grid.counts[0]
+
+            symbol = np.zeros((Nt, Ns//2+1, nf, nf), dtype=complex)
+            for q in range(nf):
+                rows = np.flatnonzero(self.grid.fields[:num_local] == q)
+                if len(rows) == 0:
+                    raise ValueError("Root process owns no dofs of field "
+                                     "{}.".format(q))
+                row = rows[0]
+                cols, vals = A.getrow(int(self.grid.dofs[row]))
+                cols = position[np.asarray(cols, dtype=int)]
+                i_row = self.grid.indices[0][row]
+                j_row = self.grid.indices[1][row]
+                for p in range(nf):
+                    ids = self.grid.fields[cols] == p
+                    di = self.grid.indices[0][cols[ids]] - i_row
+                    dj = self.grid.indices[1][cols[ids]] - j_row
+                    stencil = np.zeros((Nt, Ns))
+                    np.add.at(stencil, ((-di) % Nt, (-dj) % Ns),
+                              np.asarray(vals)[ids])
+                    symbol[:, :, q, p] = np.fft.rfft2(stencil)
+            self.symbol_inv = np.linalg.pinv(symbol)
+
+    def solve(self, values):
+        """ Apply the inverse of the flat operator to the owned dof values
+        of a vector. """
+        r = self.grid.gather(values)
+        x = None
+        if mpi_is_root():
+            r_hat = np.fft.rfft2(r)
+            x_hat = np.einsum("tsqp,pts->qts", self.symbol_inv, r_hat)
+            x = np.fft.irfft2(x_hat, s=self.grid.shape)
+        return self.grid.scatter(x)
+
+    def apply(self, pc, x, y):
+        """ Interface for PETSc python preconditioners. """
+        y.setArray(self.solve(x.getArray(readonly=True)))
+
+    def apply_to(self, ksp):
+        """ Use as preconditioner for a petsc4py KSP. """
+        pc = ksp.getPC()
+        pc.setType("python")
+        pc.setPythonContext(self)
+
+    def solver(self, A, method="gmres"):
+        """ Returns a Krylov solver for A preconditioned by the flat
+        operator. """
+        solver = df.PETScKrylovSolver(method)
+        solver.set_operator(A)
+        self.apply_to(solver.ksp())
+        return solver
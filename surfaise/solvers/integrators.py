@@ -0,0 +1,129 @@
+import dolfin as df
+import numpy as np
+
+
+class TimeIntegrator:
+    """ Time integration of semi-discrete surface PDEs of the form
+
+        mass(du/dt, v) + residual(u, v) + constraint(u, v) = 0,
+
+    where mass, residual and constraint are functions returning UFL
+    integrands (without the surface measure, which is added by
+    geo_map.form). The constraint collects the algebraic equations, e.g.
+    for auxiliary fields such as chemical potentials, which are always
+    imposed at the new time level. mass must be linear in u.
+
+    Available schemes:
+        "be":     Backward Euler.
+        "cn":     Crank-Nicolson (theta=1/2 for the residual).
+        "bdf2":   Variable step BDF2. The first step, and the first step
+                  after a restart without history, is taken with BE.
+        "sdirk2": Two-stage, L-stable SDIRK with gamma = 1 - 1/sqrt(2).
+
+    dt is typically a TimeStepSelector. Call update() after each accepted
+    step to shift the history; u_1 is then set to u_.
+    """
+    schemes = ("be", "cn", "bdf2", "sdirk2")
+
+    def __init__(self, geo_map, u_, u_1, dt, mass, residual, constraint=None,
+                 scheme="bdf2", solver_parameters=None):
+        if scheme not in self.schemes:
+            raise ValueError("Unknown scheme: {}".format(scheme))
+        self.scheme = scheme
+        self.u_ = u_
+        self.u_1 = u_1
+        self.dt = dt
+        self.dt_1 = None
+        self.dt_step = None
+        self.order = 1 if scheme == "be" else 2
+
+        W = u_.function_space()
+        v = df.TestFunction(W)
+        du = df.TrialFunction(W)
+
+        if constraint is None:
+            def constraint(u, v):
+                return 0
+
+        def C(u):
+            return constraint(u, v)
+
+        self.a = [df.Constant(1.), df.Constant(-1.), df.Constant(0.)]
+        self.u_2 = None
+        self.U = None
+        if scheme == "be":
+            F = ((mass(u_, v) - mass(u_1, v))/dt
+                 + residual(u_, v) + C(u_))
+        elif scheme == "cn":
+            F = ((mass(u_, v) - mass(u_1, v))/dt
+                 + 0.5*(residual(u_, v) + residual(u_1, v)) + C(u_))
+        elif scheme == "bdf2":
+            self.u_2 = df.Function(W, name="u_2")
+            self.u_2.assign(u_1)
+            F = ((self.a[0]*mass(u_, v) + self.a[1]*mass(u_1, v)
+                  + self.a[2]*mass(self.u_2, v))/dt
+                 + residual(u_, v) + C(u_))
+        else:
+            gamma = 1 - 1/np.sqrt(2)
+            self.U = df.Function(W, name="U")
+            F_stage = ((mass(self.U, v) - mass(u_1, v))/(gamma*dt)
+                       + residual(self.U, v) + C(self.U))
+            F = ((mass(u_, v) - mass(u_1, v))/(gamma*dt)
+                 + (1-gamma)/gamma*residual(self.U, v)
+                 + residual(u_, v) + C(u_))
+            F_stage = geo_map.form(F_stage)
+            self.stage_solver = self._create_solver(
+                F_stage, self.U, du, solver_parameters)
+
+        self.F = geo_map.form(F)
+        self.solver = self._create_solver(self.F, u_, du, solver_parameters)
+
+    def _create_solver(self, F, u, du, solver_parameters):
+        J = df.derivative(F, u, du=du)
+        problem = df.NonlinearVariationalProblem(F, u, J=J)
+        solver = df.NonlinearVariationalSolver(problem)
+        if solver_parameters is not None:
+            solver.parameters.update(solver_parameters)
+        return solver
+
+    def solve(self):
+        """ Compute u_ at the next time level from the history. """
+        self.dt_step = float(self.dt)
+        if self.scheme == "bdf2":
+            if self.dt_1 is None:
+                a = (1., -1., 0.)
+            else:
+                omega = self.dt_step/self.dt_1
+                a = ((1 + 2*omega)/(1 + omega), -(1 + omega),
+                     omega**2/(1 + omega))
+            for a_i, val in zip(self.a, a):
+                a_i.assign(val)
+        elif self.scheme == "sdirk2":
+            self.U.assign(self.u_1)
+            self.stage_solver.solve()
+            self.u_.assign(self.U)
+        self.solver.solve()
+
+    def update(self):
+        """ Shift the history after an accepted step. """
+        if self.u_2 is not None:
+            self.u_2.assign(self.u_1)
+        self.u_1.assign(self.u_)
+        self.dt_1 = self.dt_step
+
+    def history_functions(self):
+        """ Additional functions needed to restart, in the format expected
+        by save_checkpoint and load_checkpoint. """
+        if self.u_2 is None:
+            return dict()
+        return dict(previous2=self.u_2)
+
+    def save_state(self, parameters):
+        parameters["integrator_dt_1"] = self.dt_1
+
+    def load_state(self, parameters, history_loaded=True):
+        """ Restore the step history. If the history functions could not be
+        loaded, the next step is started with BE. """
+        self.dt_1 = parameters.get("integrator_dt_1", None)
+        if not history_loaded:
+            self.dt_1 = None
@@ -0,0 +1,98 @@
+import dolfin as df
+from petsc4py import PETSc
+from surfaise.common.cmd import mpi_size, info_cyan
+
+
+class GeometricMultigrid:
+    """ Geometric multigrid preconditioner on the hierarchy of reference
+    meshes of a GeoMap.
+
+    The map must be initialized with num_levels > 1. The operator is
+    rediscretized on each level from form(geo_map, u, v), which returns
+    the bilinear form on the level map, e.g. for the surface Helmholtz
+    operator:
+
+        lambda gm, u, v: gm.form(gm.dotgrad(u, v) + u*v)
+
+    Transfer operators are built geometrically between the (constrained)
+    level spaces, so periodic dofs are respected.
+    """
+    def __init__(self, geo_map, form, element=None, smoother="chebyshev",
+                 smoother_pc="jacobi", smoothing_steps=2,
+                 coarse_pc="lu"):
+        self.levels = geo_map.levels()
+        self.num_levels = len(self.levels)
+        self.smoother = smoother
+        self.smoother_pc = smoother_pc
+        self.smoothing_steps = smoothing_steps
+        self.coarse_pc = coarse_pc
+
+        self.spaces = []
+        self.operators = []
+        for level_map in self.levels:
+            if element is None:
+                S = level_map.S_ref
+            else:
+                S = df.FunctionSpace(level_map.ref_mesh, element,
+                                     constrained_domain=level_map.pbc)
+            u = df.TrialFunction(S)
+            v = df.TestFunction(S)
+            A = df.PETScMatrix()
+            df.assemble(form(level_map, u, v), tensor=A)
+            self.spaces.append(S)
+            self.operators.append(A)
+
+        self.interpolations = [None]
+        for S_coarse, S_fine in zip(self.spaces[:-1], self.spaces[1:]):
+            self.interpolations.append(
+                df.PETScDMCollection.create_transfer_matrix(S_coarse, S_fine))
+
+    @property
+    def function_space(self):
+        """ The function space on the finest level. """
+        return self.spaces[-1]
+
+    @property
+    def operator(self):
+        """ The assembled operator on the finest level. """
+        return self.operators[-1]
+
+    def apply_to(self, ksp):
+        """ Set up a petsc4py KSP to be preconditioned by multigrid. """
+        pc = ksp.getPC()
+        pc.setType(PETSc.PC.Type.MG)
+        pc.setMGLevels(self.num_levels)
+        pc.setMGType(PETSc.PC.MGType.MULTIPLICATIVE)
+        pc.setMGCycleType(PETSc.PC.MGCycleType.V)
+        for level in range(1, self.num_levels):
+            pc.setMGInterpolation(level,
+                                  self.interpolations[level].mat())
+
+        for level in range(self.num_levels):
+            A = self.operators[level].mat()
+            if level == 0:
+                ksp_level = pc.getMGCoarseSolve()
+                ksp_level.setType(PETSc.KSP.Type.PREONLY)
+                if mpi_size() > 1 and self.coarse_pc == "lu":
+                    ksp_level.getPC().setType(PETSc.PC.Type.REDUNDANT)
+                else:
+                    ksp_level.getPC().setType(self.coarse_pc)
+            else:
+                ksp_level = pc.getMGSmoother(level)
+                ksp_level.setType(self.smoother)
+                ksp_level.getPC().setType(self.smoother_pc)
+                ksp_level.setTolerances(max_it=self.smoothing_steps)
+            ksp_level.setOperators(A, A)
+
+    def solver(self, method="cg", A=None):
+        """ Returns a Krylov solver for the finest level operator (or A,
+        which must be defined on the finest space) with multigrid as
+        preconditioner. """
+        if A is None:
+            A = self.operator
+        info_cyan("Setting up geometric multigrid with {} levels".format(
+            self.num_levels))
+        solver = df.PETScKrylovSolver(method)
+        solver.set_operator(A)
+        self.apply_to(solver.ksp())
+        return solver
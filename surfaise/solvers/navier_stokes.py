@@ -0,0 +1,188 @@
+import dolfin as df
+import ufl
+from surfaise.common.cmd import info_cyan
+
+
+def _constant(value):
+    if isinstance(value, df.Constant):
+        return value
+    return df.Constant(value)
+
+
+class SurfaceIPCS:
+    """ Incremental pressure correction scheme for the surface
+    Navier-Stokes equations. In weak form, for the contravariant velocity
+    u^i and the pressure p,
+
+        rho g_ij (du^i/dt + u^k nabla_k u^i) v^j
+        + mu g_ik g^jl nabla_j u^i nabla_l v^k + mu K g_ij u^i v^j
+        - p nabla_i v^i = f_i v^i,    nabla_i u^i = 0,
+
+    where K is the Gaussian curvature. This is not the same discretization
+    as the monolithic example examples/ns_on_torus.py, and the two should
+    not be used interchangeably:
+        - The convection term here is the advective derivative
+          u^k nabla_k u^i (CovD10(u)[i, k] u[k]). The example uses the
+          contraction u^k nabla_i u^k (CovD10(u_)[k, i] u_[k]).
+        - The example solves for (u, p) together by Newton's method, with
+          incompressibility imposed weakly at each step. Here the splitting
+          introduces an O(dt) pressure error, and the velocity is only
+          discretely divergence free up to the correction step.
+    The viscous and curvature terms are the same in both.
+
+    Each step consists of three linear solves:
+        1. Tentative velocity, with the pressure from the previous step and
+           semi-implicit (linearized about u_1) or explicit convection.
+        2. Pressure increment phi from a surface Poisson equation.
+        3. Velocity correction u_ = u* - dt/rho grad phi.
+
+    The mass, viscous, Poisson and correction matrices are assembled once
+    (and again only if dt changes). With semi-implicit convection only the
+    convection matrix is assembled each step. The Krylov solvers are
+    created once and reused.
+
+    Velocity (contravariant components, P2) and pressure (P1) live in
+    separate spaces, u_ and p_ hold the current solution.
+    """
+    def __init__(self, geo_map, rho=1., mu=1., dt=1e-1, f=None,
+                 convection="semi-implicit", solver_parameters=None):
+        if convection not in ("semi-implicit", "explicit"):
+            raise ValueError("Unknown convection treatment: {}".format(
+                convection))
+        self.geo_map = geo_map
+        self.rho = _constant(rho)
+        self.mu = _constant(mu)
+        self.dt = _constant(dt)
+        self.convection = convection
+
+        self.V = df.FunctionSpace(geo_map.ref_mesh, geo_map.ref_vel,
+                                  constrained_domain=geo_map.pbc)
+        self.Q = geo_map.S_ref
+
+        self.u_ = df.Function(self.V, name="u")
+        self.u_1 = df.Function(self.V, name="u_1")
+        self.u_tent = df.Function(self.V, name="u_tent")
+        self.p_ = df.Function(self.Q, name="p")
+        self.phi = df.Function(self.Q, name="phi")
+
+        u = df.TrialFunction(self.V)
+        v = df.TestFunction(self.V)
+        phi = df.TrialFunction(self.Q)
+        q = df.TestFunction(self.Q)
+
+        i, j, k, l = ufl.Index(), ufl.Index(), ufl.Index(), ufl.Index()
+        g_ab = geo_map.g_ab
+        gab = geo_map.gab
+        CovD10 = geo_map.CovD10
+        rho = self.rho
+        mu = self.mu
+        dt = self.dt
+
+        def convect(w, u):
+            return rho*g_ab[i, j]*w[k]*CovD10(u)[i, k]*v[j]
+
+        # Tentative velocity
+        self.a_base = geo_map.form(
+            rho/dt*g_ab[i, j]*u[i]*v[j]
+            + mu*g_ab[i, k]*gab[j, l]*CovD10(u)[i, j]*CovD10(v)[k, l]
+            + mu*geo_map.K*g_ab[i, j]*u[i]*v[j])
+        L1 = (rho/dt*g_ab[i, j]*self.u_1[i]*v[j]
+              + self.p_*CovD10(v)[i, i])
+        if f is not None:
+            L1 += f[i]*v[i]
+        if convection == "explicit":
+            L1 -= convect(self.u_1, self.u_1)
+        else:
+            self.a_conv = geo_map.form(convect(self.u_1, u))
+        self.L1 = geo_map.form(L1)
+
+        # Pressure increment
+        self.a2 = geo_map.form(gab[i, j]*phi.dx(i)*q.dx(j))
+        self.L2 = geo_map.form(-rho/dt*CovD10(self.u_tent)[i, i]*q)
+
+        # Velocity correction
+        self.a3 = geo_map.form(g_ab[i, j]*u[i]*v[j])
+        self.L3 = geo_map.form(g_ab[i, j]*self.u_tent[i]*v[j]
+                               - dt/rho*self.phi.dx(j)*v[j])
+
+        self.A_base = df.PETScMatrix()
+        self.A1 = df.PETScMatrix()
+        self.A2 = df.PETScMatrix()
+        self.A3 = df.PETScMatrix()
+        self.b1 = df.PETScVector()
+        self.b2 = df.PETScVector()
+        self.b3 = df.PETScVector()
+
+        info_cyan("Assembling IPCS matrices")
+        df.assemble(self.a2, tensor=self.A2)
+        df.assemble(self.a3, tensor=self.A3)
+
+        # The pressure is determined up to a constant
+        null_vec = df.Vector(self.p_.vector())
+        self.Q.dofmap().set(null_vec, 1.0)
+        null_vec *= 1.0/null_vec.norm("l2")
+        self.null_space = df.VectorSpaceBasis([null_vec])
+        self.A2.set_nullspace(self.null_space)
+
+        if df.has_krylov_solver_preconditioner("hypre_amg"):
+            amg = "hypre_amg"
+        elif df.has_krylov_solver_preconditioner("petsc_amg"):
+            amg = "petsc_amg"
+        else:
+            amg = "jacobi"
+        self.solver1 = df.PETScKrylovSolver("gmres", "jacobi")
+        self.solver2 = df.PETScKrylovSolver("cg", amg)
+        self.solver3 = df.PETScKrylovSolver("cg", "jacobi")
+        for solver in (self.solver1, self.solver2, self.solver3):
+            solver.parameters["nonzero_initial_guess"] = True
+            if solver_parameters is not None:
+                solver.parameters.update(solver_parameters)
+        self.solver2.set_operator(self.A2)
+        self.solver3.set_operator(self.A3)
+
+        self.dt_assembled = None
+
+    def _assemble_base(self):
+        df.assemble(self.a_base, tensor=self.A_base)
+        self.dt_assembled = float(self.dt)
+        if self.convection == "explicit":
+            self.solver1.set_operator(self.A_base)
+
+    def step(self):
+        """ Advance u_ and p_ by one time step. """
+        if self.dt_assembled != float(self.dt):
+            self._assemble_base()
+        self.u_1.assign(self.u_)
+
+        # Tentative velocity
+        if self.convection == "semi-implicit":
+            df.assemble(self.a_conv, tensor=self.A1)
+            self.A1.axpy(1.0, self.A_base, True)
+            self.solver1.set_operator(self.A1)
+        df.assemble(self.L1, tensor=self.b1)
+        self.u_tent.assign(self.u_1)
+        self.solver1.solve(self.u_tent.vector(), self.b1)
+
+        # Pressure increment
+        df.assemble(self.L2, tensor=self.b2)
+        self.null_space.orthogonalize(self.b2)
+        self.phi.vector().zero()
+        self.solver2.solve(self.phi.vector(), self.b2)
+        self.p_.vector().axpy(1.0, self.phi.vector())
+
+        # Velocity correction
+        df.assemble(self.L3, tensor=self.b3)
+        self.u_.assign(self.u_tent)
+        self.solver3.solve(self.u_.vector(), self.b3)
+
+    def assign_to(self, w):
+        """ Copy (u_, p_) into a function on the mixed velocity-pressure
+        space, e.g. for output or checkpointing. """
+        df.FunctionAssigner(w.function_space(), [self.V, self.Q]).assign(
+            w, [self.u_, self.p_])
+
+    def assign_from(self, w):
+        """ Set (u_, p_) from a function on the mixed velocity-pressure
+        space. """
+        df.FunctionAssigner([self.V, self.Q], w.function_space()).assign(
+            [self.u_, self.p_], w)
@@ -0,0 +1,186 @@
+import dolfin as df
+import numpy as np
+from scipy.sparse.linalg import LinearOperator, gmres
+from surfaise.common.cmd import mpi_comm, mpi_is_root, info_red
+from .fourier import PeriodicGrid
+
+
+class SpectralPFC:
+    """ Pseudo-spectral time stepper for the conserved PFC model on doubly
+    periodic maps, with the same equations as examples/pfcbc_*.py.
+
+    psi lives on the uniform reference grid given by the dofs of the
+    structured reference mesh. Metric-dependent operators are applied in
+    divergence form,
+
+        D[A](f) = 1/sqrt_g d_a (sqrt_g A^ab d_b f),
+
+    with derivatives computed by FFTs and products in real space. Each
+    step is linearly implicit: the linear part (with stabilization stab)
+    is solved by GMRES, preconditioned by the flat operator built from
+    the averaged coefficients, and the remaining nonlinearity is explicit.
+
+    The fields (psi, mu, nu, nuhat) are kept in the mixed function u_ so
+    that output goes through Timeseries as usual.
+    """
+    def __init__(self, geo_map, tau=0.2, h=0., M=1., stab=1.,
+                 tol=1e-8, maxiter=100):
+        self.tau = tau
+        self.h = h
+        self.M = M
+        self.stab = stab
+        self.tol = tol
+        self.maxiter = maxiter
+
+        self.W = geo_map.mixed_space(4)
+        self.u_ = df.Function(self.W, name="u_")
+        self.grid = PeriodicGrid(self.W, geo_map)
+        self.shape = self.grid.shape
+        self.fields = None
+
+        if mpi_is_root():
+            T, S = self.grid.coordinates()
+            r_ref_vals = dict(zip(geo_map.AXIS_REF, (T.ravel(), S.ravel())))
+
+            def evaluate(key):
+                return geo_map.eval(key, r_ref_vals).reshape(self.shape)
+
+            def tensor(prefix):
+                return [[evaluate(prefix + j + k) for k in geo_map.AXIS_REF]
+                        for j in geo_map.AXIS_REF]
+
+            self.sqrt_g = evaluate("sqrt_g")
+            self.K = evaluate("K")
+            self.H = evaluate("H")
+            gab = tensor("g^")
+            Kab = tensor("K^")
+            self.C = dict(
+                g=self._weigh(gab),
+                K=self._weigh(Kab),
+                Kg=self._weigh(gab, self.K),
+                Hg=self._weigh(gab, self.H),
+                HK=self._weigh(Kab, self.H))
+
+            self.k = self.grid.wavenumbers()
+            # Odd derivatives of the Nyquist modes are dropped
+            self.k_odd = [k.copy() for k in self.k]
+            if self.shape[0] % 2 == 0:
+                self.k_odd[0][self.shape[0]//2, :] = 0.
+            if self.shape[1] % 2 == 0:
+                self.k_odd[1][:, -1] = 0.
+
+    def _weigh(self, A, f=1.):
+        return [[self.sqrt_g*f*A_ab for A_ab in A_a] for A_a in A]
+
+    def D(self, key, f):
+        """ Applies the divergence-form operator D[A] to the grid array f,
+        where key identifies sqrt_g*A^ab in self.C. """
+        C = self.C[key]
+        f_hat = np.fft.rfft2(f)
+        df_ = [np.fft.irfft2(1j*k*f_hat, s=self.shape) for k in self.k_odd]
+        div_hat = sum([1j*k_a*np.fft.rfft2(sum([C_ab*df_b for C_ab, df_b
+                                                in zip(C_a, df_)]))
+                       for k_a, C_a in zip(self.k_odd, C)])
+        return np.fft.irfft2(div_hat, s=self.shape)/self.sqrt_g
+
+    def laplacians(self, psi):
+        """ Returns nu and nuhat. """
+        return self.D("g", psi), self.D("K", psi)
+
+    def linear(self, psi, nu=None, nuhat=None):
+        """ Linear part of the chemical potential, including the
+        stabilization. """
+        if nu is None:
+            nu, nuhat = self.laplacians(psi)
+        mu = self.stab*psi + 4*nu + 4*self.D("g", nu)
+        if self.h != 0.:
+            m_2 = (2*(self.H*nuhat - self.K*nu)
+                   + 4*self.D("K", nuhat)
+                   - 5*self.D("Kg", nu)
+                   + 2*self.D("Hg", nuhat)
+                   + 2*self.D("HK", nu))/3
+            mu += self.h**2*m_2
+        return mu
+
+    def nonlinear(self, psi):
+        """ Explicitly treated part of the chemical potential. """
+        return ((1 + self.K*self.h**2/12)*(psi**3 + self.tau*psi)
+                - self.stab*psi)
+
+    def flat_symbol(self, dt):
+        """ Fourier symbol of the linear step operator with averaged
+        coefficients. """
+        area = np.mean(self.sqrt_g)
+
+        def kk(key):
+            C = self.C[key]
+            return sum([np.mean(C[a][b])/area*self.k[a]*self.k[b]
+                        for a in range(2) for b in range(2)])
+        k_g = kk("g")
+        k_K = kk("K")
+        H = np.mean(self.sqrt_g*self.H)/area
+        K = np.mean(self.sqrt_g*self.K)/area
+        L = self.stab - 4*k_g + 4*k_g**2
+        if self.h != 0.:
+            # Per unit psi_hat: nu = -k_g, nuhat = -k_K
+            m_2 = (2*(-H*k_K + K*k_g)
+                   + 4*k_K**2
+                   - 5*kk("Kg")*k_g
+                   + 2*kk("Hg")*k_K
+                   + 2*kk("HK")*k_g)/3
+            L = L + self.h**2*m_2
+        # Unstable parts of the linear symbol are not preconditioned
+        return 1 + dt*self.M*k_g*np.maximum(L, 0.)
+
+    def step(self, dt):
+        """ Advance the solution by one time step of length dt. Returns the
+        number of GMRES iterations. """
+        dt = float(dt)
+        num_iter = 0
+        if mpi_is_root():
+            psi_1 = self.fields[0]
+            n = psi_1.size
+
+            def matvec(x):
+                psi = x.reshape(self.shape)
+                return (psi - dt*self.M*self.D("g", self.linear(psi))).ravel()
+
+            P = self.flat_symbol(dt)
+
+            def precondition(r):
+                r_hat = np.fft.rfft2(r.reshape(self.shape))
+                return np.fft.irfft2(r_hat/P, s=self.shape).ravel()
+
+            iterations = []
+            b = psi_1 + dt*self.M*self.D("g", self.nonlinear(psi_1))
+            psi, info = gmres(
+                LinearOperator((n, n), matvec=matvec),
+                b.ravel(), x0=psi_1.ravel(), tol=self.tol,
+                maxiter=self.maxiter,
+                M=LinearOperator((n, n), matvec=precondition),
+                callback=iterations.append, callback_type="pr_norm")
+            if info != 0:
+                info_red("GMRES did not converge in SpectralPFC.step")
+            num_iter = len(iterations)
+            self._set_psi(psi.reshape(self.shape))
+        self.sync()
+        return mpi_comm().bcast(num_iter, root=0)
+
+    def _set_psi(self, psi):
+        nu, nuhat = self.laplacians(psi)
+        mu = self.linear(psi, nu, nuhat) + self.nonlinear(psi)
+        self.fields = np.array([psi, mu, nu, nuhat])
+
+    def assign(self, u):
+        """ Set the state from psi, the first component of a function in
+        the mixed space W (e.g. initial conditions interpolated there). """
+        grid = self.grid.gather(u.vector().get_local())
+        if mpi_is_root():
+            self._set_psi(grid[0])
+        self.sync()
+
+    def sync(self):
+        """ Copy the grid fields into u_. """
+        values = self.grid.scatter(self.fields)
+        self.u_.vector().set_local(values)
+        self.u_.vector().apply("insert")
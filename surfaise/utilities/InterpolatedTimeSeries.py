@@ -1,10 +1,12 @@
 import numpy as np
 import os
-from mpi4py import MPI
 from mpi4py.MPI import COMM_WORLD as comm
 import h5py
 import glob
+import multiprocessing
+from bisect import bisect_right
 import dolfin as df
+from scipy.spatial import cKDTree
 
 from surfaise.common.io import makedirs_safe, remove_safe, load_parameters
 from surfaise.common.cmd import (
@@ -12,18 +14,13 @@ from surfaise.common.cmd import (
     mpi_is_root, mpi_barrier)
 from surfaise.utilities.xdmf_utils import (
     parse_xyz_xdmf, parse_timeseries_xdmf, list_xdmf_files)
+from surfaise.utilities.h5_reader import H5Reader
 
 
 def get_middle(string, prefix, suffix):
     return string.split(prefix)[1].split(suffix)[0]
 
 
-def prep(x_list):
-    """ Prepare a list representing coordinates to be used as key in a
-    dict. """
-    return tuple(x_list)
-
-
 def numpy_to_dolfin(nodes, elements):
     """ Convert nodes and elements to a dolfin mesh object. """
     tmpfile = "tmp.h5"
@@ -75,9 +72,27 @@ def unpack_fields(folder, xdmffile):
         return None
 
 
+# Set before forking a pool in InterpolatedTimeSeries.map_steps, and
+# inherited by the workers.
+_map_ts = None
+_map_func = None
+
+
+def _map_init():
+    _map_ts.reader = H5Reader(cache_bytes=_map_ts.reader.cache_bytes,
+                              prefetch=False)
+
+
+def _map_call(step):
+    return _map_func(_map_ts, step)
+
+
 class InterpolatedTimeSeries:
-    """ Class for loading timeseries """
-    def __init__(self, folder, sought_fields=None, memory_modest=True):
+    """ Class for loading timeseries. In memory_modest mode, datasets are
+    read on access, through an LRU cache of cache_bytes, and the next step
+    is prefetched in the background if prefetch is set. """
+    def __init__(self, folder, sought_fields=None, memory_modest=True,
+                 cache_bytes=2**28, prefetch=True):
         self.folder = folder
 
         self.settings_folder = os.path.join(folder, "Settings")
@@ -102,6 +117,9 @@ class InterpolatedTimeSeries:
         self.times = dict()
         self.datasets = dict()
 
+        self.reader = H5Reader(cache_bytes=cache_bytes,
+                               prefetch=prefetch and memory_modest)
+
         self._load_timeseries(sought_fields)
 
         if len(self.fields) > 0:
@@ -121,12 +139,8 @@ class InterpolatedTimeSeries:
         self.dim = self.function_space.mesh().topology().dim()
 
         self.x = self._make_dof_coords()
-        self.xdict = self._make_xdict()
-
-        indices_function = df.Function(self.function_space)
-        self.set_val(indices_function, np.arange(len(self.nodes)))
-        self.indices = np.asarray(indices_function.vector().get_local(),
-                                  dtype=int)
+        self.indices = self._make_indices()
+        self._gather_cache = dict()
 
     def _load_timeseries(self, sought_fields=None):
         if bool(os.path.exists(self.settings_folder) and
@@ -177,32 +191,32 @@ class InterpolatedTimeSeries:
 
             self.parameters[t_0] = parameters
 
-            from_tstep_suffix = "_from_tstep_" + str(from_tstep) + ".h5"
             from_tstep_xml_suffix = "_from_tstep_" + str(from_tstep) + ".xdmf"
             for xml_file in glob.glob(os.path.join(
                     self.timeseries_folder,
                     "*" + from_tstep_xml_suffix)):
 
-                data_file = xml_file[:-4] + "h5"
-                field = get_middle(data_file,
-                                   self.timeseries_folder + "/",
-                                   from_tstep_suffix)
+                # A file may contain one field (one dataset per step) or
+                # several (shared file, one hyperslab per step).
+                dsets = parse_timeseries_xdmf(xml_file)
 
-                if bool(sought_fields is None or
-                        field in sought_fields):
+                for field, field_dsets in dsets.items():
+                    if bool(sought_fields is not None and
+                            field not in sought_fields):
+                        continue
                     if bool(field not in data):
                         data[field] = dict()
 
-                    dsets = parse_timeseries_xdmf(xml_file)
-
-                    for time, (dset_address, field_type) in dsets[field].items():
+                    for time, (dset_address, field_type) in field_dsets.items():
+                        data_file = os.path.join(self.timeseries_folder,
+                                                 dset_address[1])
+                        address = (data_file,) + tuple(dset_address[2:4])
                         # If in memory saving mode, only store
                         # address for later use.
                         if self.memory_modest:
-                            data[field][time] = (data_file, dset_address[-1])
+                            data[field][time] = address
                         else:
-                            with h5py.File(data_file, "r") as h5f:
-                                data[field][time] = np.array(h5f[dset_address[-1]])
+                            data[field][time] = self._read(address)
 
         for i, field in enumerate(data.keys()):
             tmps = sorted(data[field].items())
@@ -212,6 +226,10 @@ class InterpolatedTimeSeries:
         self.parameters = sorted(self.parameters.items())
         self.fields = self.datasets.keys()
 
+    def _read(self, address):
+        """ Read a dataset, or one step of a time series dataset. """
+        return self.reader.read(address)
+
     def _make_dof_coords(self):
         dofmap = self.function_space.dofmap()
         my_first, my_last = dofmap.ownership_range()
@@ -224,21 +242,17 @@ class InterpolatedTimeSeries:
         x = x[dofs]
         return x
 
-    def _make_xdict(self):
-        if mpi_is_root():
-            xdict = dict([(prep(list(x_list)), i) for i, x_list in
-                          enumerate(self.nodes.tolist())])
-        else:
-            xdict = None
-        xdict = comm.bcast(xdict, root=0)
-        return xdict
+    def _make_indices(self):
+        """ Node index of each owned dof, matched by coordinates. """
+        dist, indices = cKDTree(self.nodes).query(self.x)
+        if len(dist) > 0 and dist.max() > 1e-8*(
+                1. + np.abs(self.nodes).max()):
+            info_warning("Dof coordinates do not match the mesh nodes.")
+        return indices
 
     def set_val(self, f, f_data):
         vec = f.vector()
-        values = vec.get_local()
-        values[:] = [f_data[self.xdict[prep(x_val)]]
-                     for x_val in self.x.tolist()]
-        vec.set_local(values)
+        vec.set_local(np.asarray(f_data, dtype=float)[self.indices])
         vec.apply('insert')
 
     def update(self, f, field, step):
@@ -283,9 +297,10 @@ class InterpolatedTimeSeries:
         if len(key) == 2:
             field, step = key
             if self.memory_modest:
-                data_file, dset_address = self.datasets[field][step]
-                with h5py.File(data_file, "r") as h5f:
-                    return np.array(h5f[dset_address])
+                addresses = self.datasets[field]
+                if step + 1 < len(addresses):
+                    self.reader.prefetch(addresses[step+1])
+                return self._read(addresses[step])
             else:
                 return self.datasets[field][step]
 
@@ -318,15 +333,43 @@ class InterpolatedTimeSeries:
         return self.times[step]
 
     def get_nearest_step(self, time):
-        if time < self.times[0]:
+        step = bisect_right(self.times, time) - 1
+        if step < 0:
             return 0
-        for step in range(len(self)-1):
-            if time < self.times[step+1]:
-                if self.times[step+1]-time > time-self.times[step]:
-                    return step
-                else:
-                    return step+1
-        return len(self)-1
+        if step == len(self)-1:
+            return step
+        if self.times[step+1]-time > time-self.times[step]:
+            return step
+        return step+1
+
+    def at_time(self, field, time, method="linear"):
+        """ Field interpolated in time between the two bracketing steps,
+        linearly or by cubic Hermite interpolation (with slopes from
+        finite differences, which also reads the neighbouring steps).
+        Outside the time range, the first or last step is returned. """
+        step = bisect_right(self.times, time) - 1
+        if step < 0:
+            return self[field, 0]
+        if step >= len(self)-1:
+            return self[field, len(self)-1]
+        t_a, t_b = self.times[step], self.times[step+1]
+        theta = (time-t_a)/(t_b-t_a)
+        f_a = self[field, step]
+        f_b = self[field, step+1]
+        if method == "linear":
+            return (1.-theta)*f_a + theta*f_b
+        elif method == "hermite":
+            def slope(i):
+                i_a, i_b = max(i-1, 0), min(i+1, len(self)-1)
+                return ((self[field, i_b] - self[field, i_a])
+                        / (self.times[i_b] - self.times[i_a]))
+            h = t_b - t_a
+            return ((2*theta**3 - 3*theta**2 + 1)*f_a
+                    + (theta**3 - 2*theta**2 + theta)*h*slope(step)
+                    + (-2*theta**3 + 3*theta**2)*f_b
+                    + (theta**3 - theta**2)*h*slope(step+1))
+        else:
+            raise ValueError("Unknown interpolation method: {}".format(method))
 
     def get_nearest_step_and_time(self, time, dataset_str="dataset"):
         step = self.get_nearest_step(time)
@@ -337,18 +380,104 @@ class InterpolatedTimeSeries:
                              dataset_str, time, time_0))
         return step, time_0
 
-    def _operate(self, function, field):
-        return function([function(self[field, step], 0)
-                         for step in range(len(self))])
+    def _nodal_weights(self):
+        """ Lumped area weights of the nodes on the surface, i.e. the
+        reference area times sqrt_g, or None if the metric is not
+        available. """
+        if self.g_ab is None or self.elems.shape[1] != 3:
+            return None
+        x = self.nodes[self.elems, :2]
+        area = 0.5*np.abs(
+            (x[:, 1, 0] - x[:, 0, 0])*(x[:, 2, 1] - x[:, 0, 1])
+            - (x[:, 2, 0] - x[:, 0, 0])*(x[:, 1, 1] - x[:, 0, 1]))
+        w = np.zeros(len(self.nodes))
+        np.add.at(w, self.elems.ravel(), np.repeat(area/3, 3))
+        g = self.g_ab.reshape((len(self.g_ab), -1))
+        d = int(np.sqrt(g.shape[1]))
+        g = g.reshape((-1, d, d))[:, :2, :2]
+        return w*np.sqrt(np.linalg.det(g))
+
+    def _summary_key(self, field, step):
+        """ Identifies the data of a step by its address and time, or None
+        if the data is held in memory. """
+        address = self.datasets[field][step]
+        if isinstance(address, tuple):
+            return ":".join([str(a) for a in address]
+                            + [repr(self.times[step])])
+        return None
+
+    def summary(self, field):
+        """ Per-step, per-component min, max, mean, l2 (discrete norm)
+        and, if the metric is available, surface integral of field, as a
+        dict of arrays with one entry per step. The summaries of steps read
+        from file are cached in .tmp/summary.h5, keyed by address and time,
+        so that only new steps are read. """
+        keys = ["min", "max", "mean", "l2", "integral"]
+        summary = None
+        if mpi_is_root():
+            filename = os.path.join(self.tmp_folder, "summary.h5")
+            weights = self._nodal_weights()
+            if weights is None:
+                keys.remove("integral")
+            step_keys = [self._summary_key(field, step)
+                         for step in range(len(self))]
+            cached = dict()
+            with h5py.File(filename, "a") as h5f:
+                if field in h5f:
+                    group = h5f[field]
+                    if all([key in group for key in keys]):
+                        values = dict([(key, group[key][:]) for key in keys])
+                        for i, step_key in enumerate(group["keys"][:]):
+                            cached[step_key.decode()] = dict(
+                                [(key, values[key][i]) for key in keys])
+                    del h5f[field]
+
+                summary = dict([(key, []) for key in keys])
+                for step, step_key in enumerate(step_keys):
+                    if step_key in cached:
+                        entry = cached[step_key]
+                    else:
+                        data = self[field, step]
+                        entry = dict(min=np.min(data, 0),
+                                     max=np.max(data, 0),
+                                     mean=np.mean(data, 0),
+                                     l2=np.sqrt(np.sum(data**2, 0)))
+                        if weights is not None:
+                            entry["integral"] = np.tensordot(
+                                weights, data, axes=(0, 0))
+                    for key in keys:
+                        summary[key].append(entry[key])
+                for key in keys:
+                    summary[key] = np.array(summary[key])
+
+                stored = [i for i, step_key in enumerate(step_keys)
+                          if step_key is not None]
+                group = h5f.create_group(field)
+                group.create_dataset("keys", data=np.array(
+                    [step_keys[i].encode() for i in stored], dtype="S"))
+                for key in keys:
+                    group.create_dataset(key, data=summary[key][stored])
+        return comm.bcast(summary, root=0)
+
+    def _drop_summary(self, field):
+        filename = os.path.join(self.tmp_folder, "summary.h5")
+        if mpi_is_root() and os.path.exists(filename):
+            with h5py.File(filename, "a") as h5f:
+                if field in h5f:
+                    del h5f[field]
 
     def max(self, field):
-        return self._operate(np.max, field)
+        return np.max(self.summary(field)["max"])
 
     def min(self, field):
-        return self._operate(np.min, field)
+        return np.min(self.summary(field)["min"])
 
     def mean(self, field):
-        return self._operate(np.mean, field)
+        return np.mean(self.summary(field)["mean"])
+
+    def integral(self, field):
+        """ Surface integral of field at each step. """
+        return self.summary(field)["integral"]
 
     def add_field(self, field, datasets):
         if self.memory_modest:
@@ -356,6 +485,8 @@ class InterpolatedTimeSeries:
                                      field + ".h5")
             self[field] = [(data_file, field + "/" + str(step))
                            for step in range(len(datasets))]
+            self.reader.invalidate(data_file)
+            self._drop_summary(field)
             if mpi_is_root():
                 with h5py.File(data_file, "w") as h5f:
                     for step, dataset in enumerate(datasets):
@@ -366,20 +497,92 @@ class InterpolatedTimeSeries:
             self[field] = datasets
         self.fields = self.datasets.keys()
 
-    def nodal_values(self, f):
-        """ Convert dolfin function to nodal values. """
+    def statistics(self, name):
+        """ Load Statistics/<name> as a structured array with named
+        columns (memory mapped). Falls back to the text format. """
+        filename = os.path.join(self.statistics_folder, name)
+        if os.path.exists(filename + ".npy"):
+            return np.load(filename + ".npy", mmap_mode="r")
+        return np.loadtxt(filename + ".dat")
+
+    def map_steps(self, func, steps=None, reduce=None, processes=None):
+        """ Evaluate func(ts, step) for each step and return the list of
+        results in step order, or reduce(results) if reduce is given, on
+        all ranks. Steps are distributed round-robin over the MPI ranks,
+        or, when running in serial, over a pool of processes (forked,
+        each with its own reader); processes=None uses all cores. func
+        must not use collective operations.
+        """
+        if steps is None:
+            steps = range(len(self))
+        steps = list(steps)
+        size = comm.Get_size()
+        if size > 1:
+            rank = comm.Get_rank()
+            local = [func(self, step) for step in steps[rank::size]]
+            gathered = comm.allgather(local)
+            results = [None]*len(steps)
+            for rank, local in enumerate(gathered):
+                results[rank::size] = local
+        elif processes == 1 or len(steps) < 2:
+            results = [func(self, step) for step in steps]
+        else:
+            global _map_ts, _map_func
+            _map_ts, _map_func = self, func
+            self.reader.wait()
+            context = multiprocessing.get_context("fork")
+            with context.Pool(processes, initializer=_map_init) as pool:
+                results = pool.map(_map_call, steps)
+            _map_ts, _map_func = None, None
+        if reduce is not None:
+            return reduce(results)
+        return results
+
+    def close(self):
+        """ Close the open data files. """
+        self.reader.close()
+
+    def _gathered_indices(self, root):
+        """ Node indices of the owned dofs of all ranks, in rank order, on
+        root (or on all ranks if root is None), and the number per rank.
+        """
+        if root not in self._gather_cache:
+            counts = comm.allgather(len(self.indices))
+            indices = np.asarray(self.indices, dtype=np.int64)
+            gathered = None
+            if root is None:
+                gathered = np.zeros(sum(counts), dtype=np.int64)
+                comm.Allgatherv(indices, (gathered, counts))
+            elif comm.Get_rank() == root:
+                gathered = np.zeros(sum(counts), dtype=np.int64)
+                comm.Gatherv(indices, (gathered, counts), root=root)
+            else:
+                comm.Gatherv(indices, None, root=root)
+            self._gather_cache[root] = (gathered, counts)
+        return self._gather_cache[root]
+
+    def nodal_values(self, f, root=0):
+        """ Convert dolfin function to nodal values, gathered on root
+        (None is returned elsewhere), or on all ranks if root is None. """
         farray = f.vector().get_local()
-        fdim = len(farray)/len(self.indices)
-        farray = farray.reshape((len(self.indices), fdim))
+        fdim = len(farray)//len(self.indices)
+        farray = np.ascontiguousarray(
+            farray.reshape((len(self.indices), fdim)))
+
+        indices, counts = self._gathered_indices(root)
+        if indices is None:
+            comm.Gatherv(farray, None, root=root)
+            return None
+        counts = [count*fdim for count in counts]
+        recv = np.zeros((len(indices), fdim))
+        if root is None:
+            comm.Allgatherv(farray, (recv, counts))
+        else:
+            comm.Gatherv(farray, (recv, counts), root=root)
 
         arr = np.zeros((len(self.nodes), fdim))
-        arr_loc = np.zeros_like(arr)
-        for i, fval in zip(self.indices, farray):
-            arr_loc[i, :] = fval
-        comm.Allreduce(arr_loc, arr, op=MPI.SUM)
-
+        arr[indices, :] = recv
         return arr
 
-
 if __name__ == "__main__":
     info("Not intended for standalone use.")
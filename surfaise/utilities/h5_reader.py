@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+
+
+class H5Reader:
+    """ Reader for datasets in HDF5 files, addressed as (filename, loc) or,
+    for one step of a time series dataset, (filename, loc, index).
+
+    Open files are kept in a pool of at most max_files handles, and
+    recently read arrays in an LRU cache of at most cache_bytes. Arrays are
+    read with read_direct and returned read-only, since they are shared
+    with the cache. With prefetch, addresses passed to prefetch are read in
+    a background thread.
+    """
+    def __init__(self, max_files=16, cache_bytes=2**28, prefetch=True):
+        self.max_files = max_files
+        self.cache_bytes = cache_bytes
+        self.files = OrderedDict()
+        self.cache = OrderedDict()
+        self.num_bytes = 0
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.executor = None
+        if prefetch:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _file(self, filename):
+        if filename in self.files:
+            self.files.move_to_end(filename)
+        else:
+            self.files[filename] = h5py.File(filename, "r")
+            while len(self.files) > self.max_files:
+                _, h5f = self.files.popitem(last=False)
+                h5f.close()
+        return self.files[filename]
+
+    def _load(self, address):
+        with self.io_lock:
+            dset = self._file(address[0])[address[1]]
+            if len(address) > 2:
+                out = np.empty(dset.shape[1:], dtype=dset.dtype)
+                dset.read_direct(out, np.s_[address[2]])
+            else:
+                out = np.empty(dset.shape, dtype=dset.dtype)
+                dset.read_direct(out)
+        out.flags.writeable = False
+        return out
+
+    def _store(self, address, data):
+        with self.lock:
+            if address in self.cache or data.nbytes > self.cache_bytes:
+                return
+            self.cache[address] = data
+            self.num_bytes += data.nbytes
+            while self.num_bytes > self.cache_bytes:
+                _, old = self.cache.popitem(last=False)
+                self.num_bytes -= old.nbytes
+
+    def read(self, address):
+        """ Returns the (read-only) array at address. """
+        address = tuple(address)
+        with self.lock:
+            if address in self.cache:
+                self.cache.move_to_end(address)
+                return self.cache[address]
+            future = self.pending.pop(address, None)
+        if future is not None:
+            data = future.result()
+        else:
+            data = self._load(address)
+        self._store(address, data)
+        return data
+
+    def prefetch(self, address):
+        """ Start reading address in the background, if enabled. """
+        address = tuple(address)
+        if self.executor is None:
+            return
+        with self.lock:
+            if address in self.cache or address in self.pending:
+                return
+            self.pending[address] = self.executor.submit(self._load, address)
+
+    def wait(self):
+        """ Wait for background reads to finish, e.g. before forking. """
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.exception()
+
+    def invalidate(self, filename):
+        """ Close filename and drop its cached arrays, e.g. before the
+        file is rewritten. """
+        with self.lock:
+            futures = [self.pending.pop(address)
+                       for address in list(self.pending)
+                       if address[0] == filename]
+        for future in futures:
+            future.result()
+        with self.lock:
+            for address in [a for a in self.cache if a[0] == filename]:
+                self.num_bytes -= self.cache.pop(address).nbytes
+        with self.io_lock:
+            h5f = self.files.pop(filename, None)
+            if h5f is not None:
+                h5f.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        with self.lock:
+            self.pending.clear()
+            self.cache.clear()
+            self.num_bytes = 0
+        with self.io_lock:
+            for h5f in self.files.values():
+                h5f.close()
+            self.files.clear()
@@ -1,7 +1,7 @@
-import numpy as np
-from lxml import etree
-from collections import defaultdict
+import xml.etree.ElementTree as ET
+import json
 import os
+from bisect import bisect_right
 
 
 header = """<?xml version="1.0"?>
@@ -10,6 +10,15 @@ header = """<?xml version="1.0"?>
   <Domain>
     <Grid Name="{name}" GridType="Collection" CollectionType="Temporal">"""
 
+header_single = """<?xml version="1.0"?>
+<!DOCTYPE Xdmf SYSTEM "Xdmf.dtd" []>
+<Xdmf Version="3.0" xmlns:xi="http://www.w3.org/2001/XInclude">
+  <Domain>"""
+
+footer_single = """
+  </Domain>
+</Xdmf>"""
+
 grid_1st_begin = """
       <Grid Name="mesh" GridType="Uniform">"""
 
@@ -20,8 +29,8 @@ mesh_1st = """
         <Topology NumberOfElements="{num_elem}" TopologyType="{topology_type}" NodesPerElement="{nodes_per_element}">
           <DataItem Dimensions="{num_elem} {nodes_per_element}" NumberType="UInt" Format="HDF">{topology_filename}:{topology_loc}</DataItem>
         </Topology>
-        <Geometry GeometryType="XYZ">
-          <DataItem Dimensions="{num_vert} 3" Format="HDF">{xyz_filename}:{xyz_loc}</DataItem>
+        <Geometry GeometryType="{geometry_type}">
+          <DataItem Dimensions="{num_vert} {geometry_dim}" Format="HDF">{xyz_filename}:{xyz_loc}</DataItem>
         </Geometry>"""
 
 mesh_ref = """
@@ -45,6 +54,14 @@ attrib_tensor = """
         <DataItem Dimensions="{num_vert} 9" Format="HDF">{field_filename}:{field_loc}</DataItem>
       </Attribute>"""
 
+attrib_slab = """
+        <Attribute Name="{field}" AttributeType="{field_type}" Center="Node">
+          <DataItem ItemType="HyperSlab" Dimensions="{num_vert} {ncomp}" Type="HyperSlab">
+            <DataItem Dimensions="3 3" Format="XML">{index} 0 0 1 1 1 1 {num_vert} {ncomp}</DataItem>
+            <DataItem Dimensions="{num_steps} {num_vert} {ncomp}" NumberType="Float" Precision="{precision}" Format="HDF">{field_filename}:{field_loc}</DataItem>
+          </DataItem>
+        </Attribute>"""
+
 grid_end = """
       </Grid>"""
 
@@ -54,106 +71,167 @@ footer = """
 </Xdmf>"""
 
 
-def etree_to_dict(t):
-    d = {t.tag: {} if t.attrib else None}
-    children = list(t)
-    if children:
-        dd = defaultdict(list)
-        for dc in map(etree_to_dict, children):
-            for k, v in dc.items():
-                dd[k].append(v)
-        d = {t.tag: {k: v[0] if len(v) == 1 else v
-                     for k, v in dd.items()}}
-    if t.attrib:
-        d[t.tag].update(('@' + k, v)
-                        for k, v in t.attrib.items())
-    if t.text:
-        text = t.text.strip()
-        if children or t.attrib:
-            if text:
-                d[t.tag]['#text'] = text
-        else:
-            d[t.tag] = text
-    return d
+def _dimensions(item):
+    return tuple([int(a) for a in item.get("Dimensions").split()])
 
 
 def parse_xyz_xdmf(xml_file):
-    tree = etree.parse(xml_file)
-    root = tree.getroot()
-    prop = etree_to_dict(root)
-
-    grid = prop["Xdmf"]["Domain"]["Grid"]
-    geometry_address = grid["Geometry"]["DataItem"]["#text"].split(":")
-    topology_address = grid["Topology"]["DataItem"]["#text"].split(":")
-    xyz_address = grid["Attribute"]["DataItem"]["#text"].split(":")
-    topology_type = grid["Topology"]["@TopologyType"]
-    nodes_per_element = grid["Topology"]["@NodesPerElement"]
-    topology_shape = tuple(
-        [int(a) for a in
-         grid["Topology"]["DataItem"]["@Dimensions"].split(" ")])
-    geometry_shape = tuple(
-        [int(a) for a in
-         grid["Geometry"]["DataItem"]["@Dimensions"].split(" ")])
-    xyz_shape = tuple(
-        [int(a) for a in
-         grid["Attribute"]["DataItem"]["@Dimensions"].split(" ")])
+    grid = ET.parse(xml_file).getroot().find("Domain/Grid")
+    geometry_item = grid.find("Geometry/DataItem")
+    topology_item = grid.find("Topology/DataItem")
+    xyz_item = grid.find("Attribute/DataItem")
+
+    geometry_address = geometry_item.text.strip().split(":")
+    topology_address = topology_item.text.strip().split(":")
+    xyz_address = xyz_item.text.strip().split(":")
+    topology_type = grid.find("Topology").get("TopologyType")
+    nodes_per_element = grid.find("Topology").get("NodesPerElement")
+    topology_shape = _dimensions(topology_item)
+    geometry_shape = _dimensions(geometry_item)
+    xyz_shape = _dimensions(xyz_item)
 
     return (geometry_address, topology_address, xyz_address,
             geometry_shape, topology_shape, xyz_shape,
             topology_type, nodes_per_element)
 
 
-def parse_timeseries_xdmf(xml_file):
-    tree = etree.parse(xml_file)
-    root = tree.getroot()
-    prop = etree_to_dict(root)
-    grid = prop["Xdmf"]["Domain"]["Grid"]
-    dsets = dict()
-    folder = os.path.dirname(xml_file).split("/")[-1]
-    if "Grid" not in grid:
-        time = 0
-        name = grid["Attribute"]["@Name"]
-        address = grid["Attribute"]["DataItem"]["#text"].split(":")
-        address = (folder, address[0], address[1])
-        field_type = grid["Attribute"]["@AttributeType"]
-        dsets[name] = dict()
-        dsets[name][time] = (address, field_type)
-        return dsets
+def _index_filename(xml_file):
+    folder, name = os.path.split(xml_file)
+    return os.path.join(folder, "." + name + ".idx")
 
-    grid = grid["Grid"]
-    for step in grid:
-        name = step["Attribute"]["@Name"]
-        if name not in dsets:
-            dsets[name] = dict()
-        time = float(step["Time"]["@Value"])
-        address = step["Attribute"]["DataItem"]["#text"].split(":")
-        address = (folder, address[0], address[1])
-        field_type = step["Attribute"]["@AttributeType"]
-        dsets[name][time] = (address, field_type)
 
+def _load_index(xml_file, stat):
+    try:
+        with open(_index_filename(xml_file), "r") as infile:
+            index = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if bool(index.get("mtime") != stat.st_mtime or
+            index.get("size") != stat.st_size):
+        return None
+    dsets = dict()
+    for name, entries in index["dsets"].items():
+        dsets[name] = dict([(time, (tuple(address), field_type))
+                            for time, address, field_type in entries])
     return dsets
 
 
-def write_combined_xdmf(field_filenames, xyz_filename):
-    is_1st = True
+def _save_index(xml_file, stat, dsets):
+    index = dict(
+        mtime=stat.st_mtime, size=stat.st_size,
+        dsets=dict([(name, [[time, address, field_type]
+                            for time, (address, field_type)
+                            in field_dsets.items()])
+                    for name, field_dsets in dsets.items()]))
+    filename = _index_filename(xml_file)
+    tmpfilename = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmpfilename, "w") as outfile:
+            json.dump(index, outfile)
+        os.replace(tmpfilename, filename)
+    except OSError:
+        pass
+
 
+def parse_timeseries_xdmf(xml_file):
+    """ Returns dict of field -> dict of time -> (address, field_type),
+    see parse_attribute_address. The file is parsed in one streaming
+    pass, and the result is cached in an index file next to it, which is
+    used as long as the mtime and size of the file are unchanged. """
+    stat = os.stat(xml_file)
+    dsets = _load_index(xml_file, stat)
+    if dsets is not None:
+        return dsets
+
+    dsets = dict()
+    folder = os.path.dirname(xml_file).split("/")[-1]
+    time = 0
+    for _, elem in ET.iterparse(xml_file, events=("end",)):
+        if elem.tag == "Time":
+            time = float(elem.get("Value"))
+        elif elem.tag == "Attribute":
+            name = elem.get("Name")
+            if name not in dsets:
+                dsets[name] = dict()
+            dsets[name][time] = (parse_attribute_address(elem, folder),
+                                 elem.get("AttributeType"))
+        elif elem.tag == "Grid":
+            elem.clear()
+
+    _save_index(xml_file, stat, dsets)
+    return dsets
+
+
+def parse_attribute_address(attrib, folder):
+    """ Returns (folder, filename, location) for an attribute element
+    stored in its own dataset, and (folder, filename, location, index,
+    dimensions, precision) for one stored as a hyperslab of a time series
+    dataset. """
+    item = attrib.find("DataItem")
+    if item.get("ItemType", None) != "HyperSlab":
+        address = item.text.strip().split(":")
+        return (folder, address[0], address[1])
+    selection, data = item.findall("DataItem")
+    address = data.text.strip().split(":")
+    index = int(selection.text.split()[0])
+    return (folder, address[0], address[1], index,
+            data.get("Dimensions"), data.get("Precision", "8"))
+
+
+def _combined_attribute(field, dset, field_type, keys):
+    field_folder, field_filename, field_loc = dset[:3]
+    field_filename = os.path.join(field_folder, field_filename)
+    if len(dset) > 3:
+        index, dims, precision = dset[3:]
+        num_steps, _, ncomp = dims.split(" ")
+        return attrib_slab.format(
+            field=field, field_type=field_type,
+            field_filename=field_filename, field_loc=field_loc,
+            index=index, num_steps=num_steps, ncomp=ncomp,
+            precision=precision, **keys)
+    if field_type not in ("Scalar", "Vector", "Tensor"):
+        exit("Unrecognized data type!")
+    return attrib_template(field_type).format(
+        field=field, field_filename=field_filename, field_loc=field_loc,
+        **keys)
+
+
+def write_combined_xdmf(field_filenames, xyz_filename, filename,
+                        static_filenames=()):
+    """ Write an xdmf file (filename) combining all fields in the given
+    xdmf files on the mesh of xyz_filename. At each time, every field is
+    taken at its latest time not after it (or its first time). Fields in
+    static_filenames (e.g. the geometry) are not expected to change.
+
+    The file is written incrementally: the state is kept in a hidden file
+    next to it, and if the fields and the mesh are unchanged, only grids
+    for new times are appended (before the footer, which is rewritten).
+    Times after the last time written for some field of the newest run
+    segment (the files with the latest start time), e.g. in the middle of
+    a dump of a running simulation, are held back until a later call, so
+    that no grid is written with stale fields. Fields that are only found
+    in older segments (e.g. dropped after a restart) hold nothing back.
+    """
     (geometry_address, topology_address, xyz_address,
      geometry_shape, topology_shape, xyz_shape,
      topology_type, nodes_per_element) = parse_xyz_xdmf(xyz_filename)
 
-    data_type = dict()
     dsets = dict()
-    for filename in field_filenames:
-        dsets_loc = parse_timeseries_xdmf(filename)
-        for dset_loc in dsets_loc:
-            if dset_loc in dsets:
-                dsets[dset_loc].update(dsets_loc[dset_loc])
+    # Start time and last time of each field, for each non-static file
+    segments = []
+    for field_filename in list(field_filenames) + list(static_filenames):
+        dsets_loc = parse_timeseries_xdmf(field_filename)
+        if field_filename not in static_filenames and len(dsets_loc) > 0:
+            segments.append((
+                min([min(field_dsets.keys())
+                     for field_dsets in dsets_loc.values()]),
+                [max(field_dsets.keys())
+                 for field_dsets in dsets_loc.values()]))
+        for field, field_dsets in dsets_loc.items():
+            if field in dsets:
+                dsets[field].update(field_dsets)
             else:
-                dsets[dset_loc] = dsets_loc[dset_loc]
-
-    for field in dsets.keys():
-        dsets_loc_keys = list(dsets[field].keys())
-        data_type[field] = dsets[field][dsets_loc_keys[0]][1]
+                dsets[field] = dict(field_dsets)
 
     keys = dict(
         name="Timeseries",
@@ -164,54 +242,85 @@ def write_combined_xdmf(field_filenames, xyz_filename):
         topology_filename=os.path.join("Geometry", topology_address[0]),
         topology_loc=topology_address[1],
         topology_type=topology_type,
-        nodes_per_element=nodes_per_element
+        nodes_per_element=nodes_per_element,
+        geometry_type="XYZ",
+        geometry_dim=3
     )
 
-    text = header.format(**keys)
-
-    field_names = list(dsets.keys())
-    times = np.array(sorted([t for t, a in dsets[field_names[0]].items()]))
-    for field_name in field_names[1:]:
-        times = np.union1d(
-            np.array([t for t, a in dsets[field_name].items()]), times)
-
-    for field_name in field_names:
-        for i, (t, a) in enumerate(dsets[field_name].items()):
-            # assert(t == times[i])
-            pass
-
-    for i, time in enumerate(times):
+    field_names = sorted(dsets.keys())
+    field_times = dict()
+    data_type = dict()
+    for field in field_names:
+        field_times[field] = sorted(dsets[field].keys())
+        data_type[field] = dsets[field][field_times[field][0]][1]
+    times = sorted(set().union(*field_times.values()))
+    if len(segments) > 0:
+        time_start = max([start for start, _ in segments])
+        time_complete = min([min(last_times)
+                             for start, last_times in segments
+                             if start == time_start])
+        times = [time for time in times if time <= time_complete]
+
+    signature = dict(keys=keys, data_type=data_type)
+    folder, name = os.path.split(filename)
+    state_filename = os.path.join(folder, "." + name + ".state")
+    state = None
+    if os.path.exists(filename) and os.path.exists(state_filename):
+        with open(state_filename, "r") as infile:
+            state = json.load(infile)
+        if bool(state["signature"] != signature or
+                state["size"] != os.path.getsize(filename)):
+            state = None
+
+    if state is None:
+        outfile = open(filename, "w")
+        outfile.write(header.format(**keys))
+        new_times = times
+        is_1st = True
+    else:
+        outfile = open(filename, "r+")
+        outfile.seek(state["pos"])
+        new_times = [time for time in times
+                     if state["time"] is None or time > state["time"]]
+        is_1st = False
+
+    for time in new_times:
+        grid = []
         if is_1st:
-            text += grid_1st_begin.format(**keys)
-            text += mesh_1st.format(**keys)
+            grid.append(grid_1st_begin.format(**keys))
+            grid.append(mesh_1st.format(**keys))
             is_1st = False
         else:
-            text += grid_ref_begin.format(**keys)
-            text += mesh_ref.format(**keys)
-        text += timestamp.format(time=time, **keys)
+            grid.append(grid_ref_begin.format(**keys))
+            grid.append(mesh_ref.format(**keys))
+        grid.append(timestamp.format(time=time, **keys))
         for field in field_names:
-            dset_time_max = max(dsets[field].keys())
-            dset = dsets[field][min(time, dset_time_max)]
-            field_folder, field_filename, field_loc = dset[0]
-            if data_type[field] == "Scalar":
-                attrib = attrib_scalar
-            elif data_type[field] == "Vector":
-                attrib = attrib_vector
-            elif data_type[field] == "Tensor":
-                attrib = attrib_tensor
-            else:
-                exit("Unrecognized data type!")
-
-            text += attrib.format(field=field,
-                                  field_filename=os.path.join(
-                                      field_folder,
-                                      field_filename),
-                                  field_loc=field_loc,
-                                  **keys)
-
-        text += grid_end.format(**keys)
-    text += footer
-    return text
+            i = max(bisect_right(field_times[field], time) - 1, 0)
+            dset = dsets[field][field_times[field][i]][0]
+            grid.append(_combined_attribute(field, dset, data_type[field],
+                                            keys))
+        grid.append(grid_end.format(**keys))
+        outfile.write("".join(grid))
+
+    pos = outfile.tell()
+    outfile.write(footer)
+    outfile.truncate()
+    size = outfile.tell()
+    outfile.close()
+
+    last_time = times[-1] if len(times) > 0 else None
+    if state is not None and len(new_times) == 0:
+        last_time = state["time"]
+    with open(state_filename, "w") as outfile:
+        json.dump(dict(signature=signature, pos=pos, size=size,
+                       time=last_time), outfile)
+
+
+def attrib_template(field_type):
+    """ Attribute template for the given AttributeType. """
+    return dict(Scalar=attrib_scalar,
+                Vector=attrib_vector,
+                Tensor=attrib_tensor)[field_type]
 
 
 def list_xdmf_files(folder):
@@ -15,9 +15,8 @@ if __name__ == "__main__" or __name__ == "surfaise.visualize":
 
     tsfilenames = list_xdmf_files(tsfolder)
     geofilenames = list_xdmf_files(geofolder)
-    field_filenames = tsfilenames + geofilenames
     xyz_filename = os.path.join(geofolder, "xyz.xdmf")
 
-    text = write_combined_xdmf(field_filenames, xyz_filename)
-    with open(os.path.join(folder, "visualize.xdmf"), "w") as outfile:
-        outfile.write(text)
+    write_combined_xdmf(tsfilenames, xyz_filename,
+                        os.path.join(folder, "visualize.xdmf"),
+                        static_filenames=geofilenames)